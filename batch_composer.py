@@ -0,0 +1,261 @@
+"""批次作曲：讀取作品清單（manifest），以多行程平行產生 MIDI 檔案。
+
+清單為 JSON 陣列，或是含有 "jobs" 欄位的物件，每個作品的格式如下：
+
+    {
+        "notes": ["C4", "E4", null, 67, ...],
+        "patterns": [["上升琶音", "鋼琴"], ["基本和弦", "大提琴"]],
+        "output": "piece_0001.mid",
+        "measures": 2000
+    }
+
+notes 可使用音名或 MIDI 值（null 表示空格），patterns 為琶音模式與
+AVAILABLE_INSTRUMENTS 中的樂器名稱。measures 可省略，指定時會產生剛好
+該小節數的長篇樂曲。音符數與小節數分別不得超過 MAX_NOTES 與 MAX_MEASURES。
+
+用法：
+    python batch_composer.py manifest.json --workers 8 --out-dir renders
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 單一作品的上限，避免一個作品佔住工作行程過久
+MAX_NOTES = 10000
+MAX_MEASURES = 10000
+
+# 每個工作行程各自持有一份已載入的 music_composer（以及 music21）與快取
+_composer = None
+_cache = None
+
+
+def _init_worker(cache_dir=None, cache_max_bytes=None):
+    """工作行程初始化：預先載入 music21，之後的作品不再付出匯入成本"""
+    global _composer, _cache
+    import music_composer
+    music_composer.preload_music21()
+    _composer = music_composer
+    if cache_dir:
+        import render_cache
+        _cache = render_cache.RenderCache(cache_dir, cache_max_bytes or render_cache.DEFAULT_MAX_BYTES)
+
+
+def load_manifest(path):
+    """讀取作品清單並回傳作品列表"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    jobs = data.get('jobs', []) if isinstance(data, dict) else data
+    if not isinstance(jobs, list):
+        raise ValueError("作品清單必須是陣列，或含有 jobs 陣列的物件")
+    return jobs
+
+
+class JobTooLarge(ValueError):
+    """作品超過 MAX_NOTES 或 MAX_MEASURES"""
+
+
+def check_job_size(job):
+    """檢查作品大小，不需載入 music_composer；超過上限時引發 JobTooLarge"""
+    if not isinstance(job, dict):
+        return
+    notes = job.get('notes')
+    if isinstance(notes, list) and len(notes) > MAX_NOTES:
+        raise JobTooLarge(f"音符數超過上限 {MAX_NOTES}：{len(notes)}")
+    measures = job.get('measures')
+    if isinstance(measures, int) and measures > MAX_MEASURES:
+        raise JobTooLarge(f"小節數超過上限 {MAX_MEASURES}：{measures}")
+
+
+def job_to_arguments(composer, job):
+    """將清單中的作品轉換成 build_score 所需的 selected_notes 與 pattern_instruments
+
+    作品格式錯誤（欄位型別不對、無法解析的音名、未知的琶音模式或樂器）時引發 ValueError，
+    超過大小上限時引發 JobTooLarge。
+    """
+    if not isinstance(job, dict):
+        raise ValueError("作品必須是物件")
+    check_job_size(job)
+    notes = job.get('notes', [])
+    if not isinstance(notes, list):
+        raise ValueError("notes 必須是陣列")
+    selected_notes = []
+    for value in notes:
+        if value is None or value == '':
+            selected_notes.append([None])
+        elif isinstance(value, int) and not isinstance(value, bool):
+            if not 0 <= value <= 127:
+                raise ValueError(f"MIDI 值超出範圍：{value}")
+            # 第 -1 八度沒有能解析回來的音名，直接保留 MIDI 值
+            selected_notes.append([composer.midi_to_cell(value)])
+        elif isinstance(value, str):
+            try:
+                composer.note_name_to_midi(value)
+            except Exception:
+                raise ValueError(f"無效的音名：{value}") from None
+            selected_notes.append([value])
+        else:
+            raise ValueError(f"無效的音符：{value!r}")
+
+    entries = job.get('patterns', [])
+    if not isinstance(entries, list):
+        raise ValueError("patterns 必須是陣列")
+    patterns = composer.get_arpeggio_patterns()
+    pattern_instruments = []
+    for entry in entries:
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            raise ValueError(f"伴奏的格式為 [琶音模式, 樂器]：{entry!r}")
+        pattern_name, inst_name = entry
+        if not isinstance(pattern_name, str) or not isinstance(inst_name, str):
+            raise ValueError(f"伴奏的格式為 [琶音模式, 樂器]：{entry!r}")
+        if pattern_name not in patterns:
+            raise ValueError(f"未知的琶音模式：{pattern_name}")
+        if inst_name not in composer.AVAILABLE_INSTRUMENTS:
+            raise ValueError(f"未知的樂器：{inst_name}")
+        pattern_instruments.append((pattern_name, composer.AVAILABLE_INSTRUMENTS[inst_name]))
+    return selected_notes, pattern_instruments
+
+
+def render_job(job, output=None, stats=None):
+    """在工作行程中產生單一作品；output 為 None 時回傳 MIDI 位元組，否則回傳檔案路徑
+
+    作品格式錯誤時引發 ValueError。
+    """
+    if _composer is None:
+        _init_worker()
+    selected_notes, pattern_instruments = job_to_arguments(_composer, job)
+    if all(row[0] is None for row in selected_notes):
+        raise ValueError("作品沒有任何音符")
+    measures = job.get('measures')
+    if measures is not None and (not isinstance(measures, int) or isinstance(measures, bool)
+                                 or measures <= 0):
+        raise ValueError(f"measures 必須是正整數：{measures!r}")
+    return _composer.build_score(selected_notes, pattern_instruments, output,
+                                 num_measures=measures, stats=stats, cache=_cache)
+
+
+def _run_job(index, job, out_dir):
+    """在工作行程中產生單一作品，回傳結果摘要（不拋出例外）"""
+    if _composer is None:
+        _init_worker()
+    start = time.perf_counter()
+    output = f"output_{index:05d}.mid"
+    stats = _composer.RenderStats()
+    try:
+        if not isinstance(job, dict):
+            raise ValueError("作品必須是物件")
+        if job.get('output') is not None:
+            if not isinstance(job['output'], str) or not job['output']:
+                raise ValueError(f"output 必須是檔名字串：{job['output']!r}")
+            output = job['output']
+        if out_dir:
+            output = os.path.join(out_dir, output)
+        path = render_job(job, output, stats)
+        return {'index': index, 'output': path, 'ok': True,
+                'seconds': time.perf_counter() - start, 'error': None,
+                'stats': stats.as_dict()}
+    except Exception as e:
+        return {'index': index, 'output': output, 'ok': False,
+                'seconds': time.perf_counter() - start,
+                'error': f"{type(e).__name__}: {e}", 'stats': stats.as_dict()}
+
+
+def run_batch(jobs, workers=None, out_dir=None, on_result=None, cache_dir=None,
+              cache_max_bytes=None):
+    """以行程池平行產生所有作品，回傳 (結果列表, 統計摘要)
+
+    on_result 若有提供，會在每個作品完成時以結果摘要呼叫一次。
+    cache_dir 指定時，各工作行程共用該目錄作為產生結果的快取（見 render_cache）。
+    """
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_dir, cache_max_bytes)) as executor:
+        futures = [executor.submit(_run_job, i, job, out_dir) for i, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_result:
+                on_result(result)
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda r: r['index'])
+
+    succeeded = [r for r in results if r['ok']]
+    job_seconds = [r['seconds'] for r in results]
+    # 所有作品各階段耗時與計數的總和
+    stage_seconds = {}
+    counters = {}
+    for r in results:
+        for name, seconds in r['stats']['stages'].items():
+            stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+        for name, value in r['stats']['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    summary = {
+        'jobs': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'workers': workers,
+        'wall_seconds': elapsed,
+        'jobs_per_second': len(results) / elapsed if elapsed > 0 else 0.0,
+        'mean_job_seconds': sum(job_seconds) / len(job_seconds) if job_seconds else 0.0,
+        'max_job_seconds': max(job_seconds) if job_seconds else 0.0,
+        'stage_seconds': stage_seconds,
+        'counters': counters,
+    }
+    return results, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MIDI 作曲助手：批次作曲模式")
+    parser.add_argument('manifest', help="作品清單 JSON 檔")
+    parser.add_argument('--workers', type=int, default=None, help="工作行程數（預設為 CPU 核心數）")
+    parser.add_argument('--out-dir', default=None, help="輸出目錄")
+    parser.add_argument('--report', default=None, help="將每個作品的結果與統計寫入 JSON 檔")
+    parser.add_argument('--quiet', action='store_true', help="不逐一顯示作品結果")
+    parser.add_argument('--cache', default=None, help="產生結果的快取目錄")
+    parser.add_argument('--cache-max-mb', type=float, default=None,
+                        help="快取大小上限（MB，預設 256）")
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+
+    def print_result(r):
+        if args.quiet:
+            return
+        status = "OK  " if r['ok'] else "FAIL"
+        line = f"[{status}] #{r['index']:<5} {r['seconds']:7.3f}s  {r['output']}"
+        if r['error']:
+            line += f"  ({r['error']})"
+        print(line, flush=True)
+
+    cache_max_bytes = int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None
+    results, summary = run_batch(jobs, args.workers, args.out_dir, print_result,
+                                 args.cache, cache_max_bytes)
+
+    print(f"完成 {summary['succeeded']}/{summary['jobs']} 個作品，失敗 {summary['failed']} 個；"
+          f"{summary['workers']} 個行程，耗時 {summary['wall_seconds']:.2f}s，"
+          f"{summary['jobs_per_second']:.2f} 個/秒，"
+          f"平均每個 {summary['mean_job_seconds']:.3f}s（最長 {summary['max_job_seconds']:.3f}s）")
+    if args.cache:
+        hits = summary['counters'].get('cache_hits', 0)
+        misses = summary['counters'].get('cache_misses', 0)
+        print(f"快取命中 {hits} 次，未命中 {misses} 次")
+    if summary['stage_seconds']:
+        print("各階段累計耗時：" + "，".join(
+            f"{name} {seconds:.3f}s" for name, seconds in
+            sorted(summary['stage_seconds'].items(), key=lambda x: x[1], reverse=True)))
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'results': results}, f, ensure_ascii=False, indent=2)
+
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
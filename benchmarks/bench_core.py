@@ -0,0 +1,208 @@
+"""作曲核心的基準測試：量測各階段的耗時與記憶體峰值，並與儲存的基準值比較。
+
+固定亂數種子產生測試資料：16 個音符的網格、長篇旋律，以及由
+get_arpeggio_patterns() 組成的 1~10 個伴奏聲部。
+
+用法：
+    python benchmarks/bench_core.py                      # 執行並與基準值比較（若存在）
+    python benchmarks/bench_core.py --save-baseline      # 將結果存成新的基準值
+    python benchmarks/bench_core.py --filter build_score --repeat 10
+    python benchmarks/bench_core.py --include-music21    # 也量測 music21 輸出路徑
+
+與基準值比較時，若任一階段的中位數耗時或記憶體峰值超過基準值 (1 + --tolerance) 倍，
+以非零狀態結束。
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import audio_preview  # noqa: E402
+import midi_io  # noqa: E402
+import music_composer as mc  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+INSTRUMENT_NAMES = list(mc.AVAILABLE_INSTRUMENTS)
+PATTERN_NAMES = list(mc.get_arpeggio_patterns())
+
+
+# ========== 測試資料 ==========
+
+def make_grid(seed, length=16):
+    """產生 C 大調附近、偶有空格的音符網格（selected_notes 格式）"""
+    rng = random.Random(seed)
+    scale = [0, 2, 4, 5, 7, 9, 11]
+    grid = []
+    for _ in range(length):
+        if rng.random() < 0.1:
+            grid.append([None])
+        else:
+            midi_val = 60 + rng.choice(scale) + 12 * rng.choice([-1, 0, 0, 1])
+            grid.append([mc.midi_to_note_name(midi_val)])
+    return grid
+
+
+def make_parts(count):
+    """依序輪流使用各琶音模式與樂器，組成 count 個伴奏聲部"""
+    return [(PATTERN_NAMES[i % len(PATTERN_NAMES)],
+             mc.AVAILABLE_INSTRUMENTS[INSTRUMENT_NAMES[i % len(INSTRUMENT_NAMES)]])
+            for i in range(count)]
+
+
+# ========== 各階段 ==========
+
+def build_stages(tmp_dir, include_music21, executor):
+    """回傳 (名稱, 無參數函式) 的列表；executor 用於量測各聲部平行編碼"""
+    grid = make_grid(1)
+    grids = [make_grid(seed) for seed in range(1000)]
+    rng = random.Random(2)
+    values = [rng.randint(36, 96) for _ in range(10000)]
+    sequence = [mc.note_name_to_midi(row[0]) - 60 for row in grid if row[0]]
+    long_sequence = sequence * 64
+    batch_sequences = [[mc.note_name_to_midi(row[0]) - 60 if row[0] else 0 for row in g]
+                       for g in grids]
+    variation_forms = [mc.MELODY_FORM, ('C', 'A', "A'"), ('T2', 'T1')]
+    output = os.path.join(tmp_dir, 'bench.mid')
+
+    stages = [
+        ('fix_the_note/10k', lambda: [mc.fix_the_note(mc.C_MAJOR, v) for v in values]),
+        ('generate_melody/16', lambda: mc.generate_melody(sequence, mc.C_MAJOR)),
+        ('generate_melody/1k', lambda: mc.generate_melody(long_sequence, mc.C_MAJOR)),
+        ('generate_melody_batch/1kx16', lambda: mc.generate_melody_batch(batch_sequences, mc.C_MAJOR)),
+        ('generate_variations_batch/1kx36',
+         lambda: mc.generate_variations_batch(grids, variation_forms, (0, 2, 4, 7), (None, 0, 1))),
+        ('generate_extended_melody/16', lambda: mc.generate_extended_melody(grid)),
+        ('generate_extended_melody/512bars',
+         lambda: mc.generate_extended_melody(grid, num_measures=512)),
+        ('suggest_chords/16', lambda: mc.suggest_chords(grid)),
+        ('suggest_chords_batch/1k', lambda: mc.suggest_chords_batch(grids)),
+    ]
+    for count in (1, 2, 5, 10):
+        parts = make_parts(count)
+        stages.append((f'build_score/parts={count}',
+                       lambda parts=parts: mc.build_score(grid, parts, output)))
+    stages.append(('build_score/parts=5/512bars',
+                   lambda: mc.build_score(grid, make_parts(5), output, num_measures=512)))
+    long_plan = mc.plan_score(grid, num_measures=512)
+    stages.append(('score_notes/parts=10/512bars',
+                   lambda: mc.score_notes(long_plan, make_parts(10))))
+    stages.append(('build_score/parts=10/512bars/parallel',
+                   lambda: mc.build_score(grid, make_parts(10), output, num_measures=512,
+                                          executor=executor)))
+
+    # 只量測 MIDI 編碼：事件先展開成列表
+    plan = mc.plan_score(grid)
+    track_parts = [(list(plan.melody_events), 0, 'Piano')]
+    for pattern_name, inst in make_parts(10):
+        track_parts.append((mc.accompaniment_events(pattern_name, plan.chord_progression,
+                                                    plan.transposition_semitones,
+                                                    plan.total_measures),
+                            inst.midiProgram or 0, inst.instrumentName))
+    stages.append(('midi_write/parts=10', lambda: midi_io.write_smf_stream(io.BytesIO(), track_parts)))
+    wav_output = os.path.join(tmp_dir, 'bench.wav')
+    stages.append(('audio_preview/parts=2',
+                   lambda: audio_preview.render_preview(grid, make_parts(2), wav_output)))
+
+    if include_music21:
+        for count in (1, 5):
+            parts = make_parts(count)
+            stages.append((f'build_score_music21/parts={count}',
+                           lambda parts=parts: mc.build_score(grid, parts, output, writer='music21')))
+    return stages
+
+
+def measure(fn, repeat):
+    """先暖身一次，再量測 repeat 次耗時；另以 tracemalloc 單獨量測一次記憶體峰值"""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'median_ms': statistics.median(times) * 1000,
+            'min_ms': min(times) * 1000,
+            'peak_kb': peak / 1024}
+
+
+def compare(results, baseline, tolerance):
+    """回傳超過容許範圍的項目說明列表"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('median_ms', 'peak_kb'):
+            if base[metric] > 0 and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {result[metric]:.2f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="作曲核心基準測試")
+    parser.add_argument('--repeat', type=int, default=5, help="每個階段的量測次數（預設 5）")
+    parser.add_argument('--filter', default=None, help="只執行名稱包含此字串的階段")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="基準值 JSON 檔")
+    parser.add_argument('--save-baseline', action='store_true', help="將本次結果存成基準值")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="容許比基準值慢或多用的比例（預設 0.25）")
+    parser.add_argument('--include-music21', action='store_true', help="也量測 music21 輸出路徑")
+    parser.add_argument('--json', default=None, help="將結果另存為 JSON 檔")
+    args = parser.parse_args(argv)
+
+    mc.preload_music21()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor() as executor:
+        for name, fn in build_stages(tmp_dir, args.include_music21, executor):
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(fn, args.repeat)
+            r = results[name]
+            print(f"{name:<36} {r['median_ms']:10.3f} ms  (min {r['min_ms']:9.3f})  "
+                  f"peak {r['peak_kb']:10.1f} KB", flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"已儲存基準值：{args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("尚無基準值，可用 --save-baseline 建立")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("效能退化：")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"與基準值相比沒有超過 {args.tolerance:.0%} 的退化")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""啟動時間基準測試：量測匯入 music_composer 的耗時，並確認匯入時沒有載入 music21。
+
+每次量測都在新的 Python 行程中進行，取中位數；超過 --max-seconds 或匯入時
+已載入 music21 時以非零狀態結束，可直接放進 CI 以攔截啟動時間的退化。
+
+用法：
+    python benchmarks/bench_import.py --runs 10 --max-seconds 0.15
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import music_composer
+import_seconds = time.perf_counter() - start
+loaded = sorted(m for m in sys.modules if m == 'music21' or m.startswith('music21.'))
+start = time.perf_counter()
+music_composer.preload_music21()
+preload_seconds = time.perf_counter() - start
+print(json.dumps({'import': import_seconds, 'preload': preload_seconds, 'music21_loaded': loaded}))
+"""
+
+
+def measure_once():
+    """在新行程中匯入一次，回傳量測結果"""
+    out = subprocess.run([sys.executable, '-c', _PROBE], cwd=REPO_ROOT,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="量測 music_composer 的匯入時間")
+    parser.add_argument('--runs', type=int, default=5, help="量測次數（預設 5）")
+    parser.add_argument('--max-seconds', type=float, default=0.15,
+                        help="匯入時間中位數的上限（預設 0.15 秒）")
+    args = parser.parse_args(argv)
+
+    samples = [measure_once() for _ in range(args.runs)]
+    import_median = statistics.median(s['import'] for s in samples)
+    preload_median = statistics.median(s['preload'] for s in samples)
+    loaded = samples[-1]['music21_loaded']
+
+    print(f"import music_composer : {import_median * 1000:8.1f} ms（中位數，{args.runs} 次）")
+    print(f"preload_music21()     : {preload_median * 1000:8.1f} ms")
+
+    failed = False
+    if loaded:
+        print(f"退化：匯入時已載入 music21 模組：{', '.join(loaded[:5])}")
+        failed = True
+    if import_median > args.max_seconds:
+        print(f"退化：匯入時間超過上限 {args.max_seconds * 1000:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
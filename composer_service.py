@@ -0,0 +1,417 @@
+"""作曲服務：以 asyncio 提供 HTTP 介面，接收音符網格與伴奏設定，回傳 MIDI。
+
+產生工作交給預先啟動的行程池：每個工作行程在啟動時載入 music21 並試產生一首
+短曲，之後的請求不再付出匯入與初始化的成本。同時執行的產生數不超過工作行程數，
+其餘請求在佇列中等待；等待數達到上限時立即回應 503（附 Retry-After），
+不讓請求無限堆積。工作行程異常結束使行程池損壞時，當下的請求回應 500，
+服務隨即換上新的行程池並在背景預熱，之後的請求照常處理。
+
+超過 batch_composer.MAX_NOTES 或 MAX_MEASURES 的作品在排隊前就回應 413。每個作品
+最多產生 timeout 秒，逾時回應 504；逾時或客戶端中途斷線時同樣換上新的行程池，
+舊行程池在其餘進行中的作品完成後結束，佔住工作行程的作品隨之中止。
+
+端點：
+    POST /render   內容為 JSON 作品（格式同 batch_composer 的清單項目，不需要 output），
+                   成功時回傳 audio/midi，標頭 X-Queue-Ms、X-Render-Ms 為排隊與產生耗時
+    GET  /stats    佇列狀態、請求計數與延遲百分位數（毫秒）
+    GET  /health   服務是否已就緒
+
+用法：
+    python composer_service.py --port 8765 --workers 4 --max-queue 64 --timeout 30
+    python composer_service.py --unix /tmp/composer.sock --cache ~/.cache/music-composer
+    curl -X POST --data '{"notes": ["C4", "E4", "G4"], "patterns": [["上升琶音", "鋼琴"]]}' \\
+         http://127.0.0.1:8765/render -o piece.mid
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+
+import batch_composer
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUE = 64
+# 單一作品的產生期限（秒）
+DEFAULT_TIMEOUT = 30.0
+# 產生期間檢查客戶端是否已斷線的間隔（秒）
+DISCONNECT_POLL = 0.2
+# 請求內容的上限（位元組）
+MAX_BODY_BYTES = 1 << 20
+# 延遲統計只保留最近的請求數
+LATENCY_WINDOW = 10000
+# 預熱時每個工作行程試產生的作品
+_WARMUP_JOB = {'notes': ['C4', 'E4', 'G4', 'C5'], 'patterns': [['上升琶音', '鋼琴']]}
+
+
+class ServiceBusy(Exception):
+    """等待中的請求已達上限"""
+
+
+class RenderTimeout(Exception):
+    """作品超過產生期限"""
+
+
+class ClientGone(Exception):
+    """客戶端在作品產生完成前斷線"""
+
+
+def _render(job):
+    """在工作行程中產生作品，回傳 (MIDI 位元組, 產生秒數)"""
+    start = time.perf_counter()
+    data = batch_composer.render_job(job)
+    return data, time.perf_counter() - start
+
+
+def _warm_up(delay):
+    """預熱工作：等待 delay 秒讓其他預熱工作分配到不同的行程，再試產生一首短曲"""
+    time.sleep(delay)
+    batch_composer.render_job(_WARMUP_JOB)
+    return os.getpid()
+
+
+# ========== 統計 ==========
+
+class LatencyWindow:
+    """保存最近 size 筆耗時（秒），計算百分位數"""
+    def __init__(self, size=LATENCY_WINDOW):
+        self._values = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._values.append(seconds)
+
+    def summary(self):
+        """回傳筆數與平均、p50、p90、p99、最大值（毫秒）"""
+        if not self._values:
+            return {'count': 0}
+        ordered = sorted(self._values)
+        def pick(q):
+            return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+        return {'count': len(ordered),
+                'mean_ms': sum(ordered) / len(ordered) * 1000,
+                'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99),
+                'max_ms': ordered[-1] * 1000}
+
+
+# ========== 服務 ==========
+
+class ComposerService:
+    """管理行程池、請求佇列與統計；HTTP 處理見 handle"""
+    def __init__(self, workers=None, max_queue=DEFAULT_MAX_QUEUE, cache_dir=None,
+                 cache_max_bytes=None, timeout=DEFAULT_TIMEOUT):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._initargs = (cache_dir, cache_max_bytes)
+        self._executor = None
+        self._in_flight = {}   # 行程池 -> 仍在等待結果的作品數
+        self._retired = set()  # 已被取代、等待進行中作品完成後結束的行程池
+        self._slots = None
+        self.ready = False
+        self.waiting = 0      # 在佇列中等待的請求數
+        self.running = 0      # 正在產生的請求數
+        self.counters = {'completed': 0, 'rejected': 0, 'bad_request': 0, 'too_large': 0,
+                         'failed': 0, 'timed_out': 0, 'abandoned': 0, 'pool_restarts': 0}
+        self.queue_latency = LatencyWindow()
+        self.render_latency = LatencyWindow()
+        self.total_latency = LatencyWindow()
+
+    async def start(self):
+        """啟動行程池並讓每個工作行程都完成預熱"""
+        loop = asyncio.get_running_loop()
+        self._executor = self._new_executor()
+        self._slots = asyncio.Semaphore(self.workers)
+        pids = await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up, 0.2)
+                                      for _ in range(self.workers)))
+        self.ready = True
+        return len(set(pids))
+
+    def _new_executor(self):
+        # 重建行程池時已有開啟的連線，fork 出的工作行程會繼承這些 socket，使連線無法關閉；
+        # 有 forkserver 時改由它產生工作行程
+        context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=batch_composer._init_worker,
+                                   initargs=self._initargs)
+
+    def _restart_pool(self, old):
+        """以新的行程池取代 old（其他請求已經換過時不再重複），並在背景預熱
+
+        old 可能已損壞，或仍有工作行程卡在逾時、被放棄的作品上；old 在其餘進行中的
+        作品完成後結束所有工作行程。
+        """
+        if self._executor is not old:
+            return
+        self._executor = self._new_executor()
+        self.counters['pool_restarts'] += 1
+        for _ in range(self.workers):
+            self._executor.submit(_warm_up, 0.2)
+        self._retired.add(old)
+        if not self._in_flight.get(old):
+            self._terminate_pool(old)
+
+    def _terminate_pool(self, executor):
+        """結束 executor 的所有工作行程（包括仍在產生中的）"""
+        self._retired.discard(executor)
+        self._in_flight.pop(executor, None)
+        # shutdown 不會中止執行中的工作，需直接結束工作行程
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        for executor in list(self._retired):
+            self._terminate_pool(executor)
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    async def render(self, job, disconnected=None):
+        """排隊後在行程池中產生作品，回傳 (MIDI 位元組, 排隊秒數, 產生秒數)
+
+        disconnected 若有提供，為回傳客戶端是否已斷線的函式。等待數已達 max_queue 時
+        引發 ServiceBusy；作品過大時引發 JobTooLarge；作品格式錯誤時引發 ValueError；
+        超過 timeout 秒時引發 RenderTimeout；客戶端斷線時引發 ClientGone；工作行程異常
+        結束時引發 BrokenProcessPool。後三者都會換上新的行程池。
+        """
+        batch_composer.check_job_size(job)
+        if self.waiting >= self.max_queue:
+            self.counters['rejected'] += 1
+            raise ServiceBusy()
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        queued = time.perf_counter() - start
+        if disconnected is not None and disconnected():
+            self._slots.release()
+            self.counters['abandoned'] += 1
+            raise ClientGone()
+        self.running += 1
+        executor = self._executor
+        self._in_flight[executor] = self._in_flight.get(executor, 0) + 1
+        future = asyncio.get_running_loop().run_in_executor(executor, _render, job)
+        try:
+            data, rendered = await asyncio.wait_for(_result_unless_gone(future, disconnected),
+                                                    self.timeout)
+        except asyncio.TimeoutError:
+            self.counters['timed_out'] += 1
+            self._restart_pool(executor)
+            raise RenderTimeout() from None
+        except (ClientGone, asyncio.CancelledError):
+            self.counters['abandoned'] += 1
+            self._restart_pool(executor)
+            raise
+        except BrokenProcessPool:
+            self._restart_pool(executor)
+            raise
+        finally:
+            future.cancel()
+            self.running -= 1
+            self._slots.release()
+            self._in_flight[executor] -= 1
+            if executor in self._retired and not self._in_flight[executor]:
+                self._terminate_pool(executor)
+        self.counters['completed'] += 1
+        self.queue_latency.add(queued)
+        self.render_latency.add(rendered)
+        self.total_latency.add(time.perf_counter() - start)
+        return data, queued, rendered
+
+    def stats(self):
+        return {'ready': self.ready, 'workers': self.workers, 'max_queue': self.max_queue,
+                'waiting': self.waiting, 'running': self.running,
+                'counters': dict(self.counters),
+                'latency': {'queue': self.queue_latency.summary(),
+                            'render': self.render_latency.summary(),
+                            'total': self.total_latency.summary()}}
+
+    # ---- HTTP
+
+    async def handle(self, reader, writer):
+        """處理一個連線上的請求（支援 keep-alive）"""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await _respond(writer, 431, _json_body({'error': "標頭過長"}), close=True)
+                    break
+                keep_alive = await self._handle_request(head, reader, writer)
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _handle_request(self, head, reader, writer):
+        """處理單一請求，回傳連線是否保持開啟"""
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await _respond(writer, 400, _json_body({'error': "無效的請求列"}), close=True)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_BODY_BYTES:
+            await _respond(writer, 413, _json_body({'error': "請求內容過大或長度無效"}), close=True)
+            return False
+        try:
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return False
+
+        path = target.split('?', 1)[0]
+        result = await self._dispatch(method, path, body, reader.at_eof)
+        if result is None:
+            return False
+        status, payload, extra = result
+        await _respond(writer, status, payload, extra, close=not keep_alive)
+        return keep_alive
+
+    async def _dispatch(self, method, path, body, disconnected=None):
+        """回傳 (狀態碼, (內容類型, 內容位元組), 額外標頭)；客戶端已斷線時回傳 None"""
+        if path == '/health' and method == 'GET':
+            return (200 if self.ready else 503), _json_body({'ready': self.ready}), {}
+        if path == '/stats' and method == 'GET':
+            return 200, _json_body(self.stats()), {}
+        if path != '/render':
+            return 404, _json_body({'error': f"找不到 {path}"}), {}
+        if method != 'POST':
+            return 405, _json_body({'error': "請使用 POST"}), {'Allow': 'POST'}
+
+        try:
+            job = json.loads(body.decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError("作品必須是 JSON 物件")
+        except (UnicodeDecodeError, ValueError) as e:
+            self.counters['bad_request'] += 1
+            return 400, _json_body({'error': f"無效的 JSON：{e}"}), {}
+        try:
+            data, queued, rendered = await self.render(job, disconnected)
+        except ServiceBusy:
+            return 503, _json_body({'error': "產生佇列已滿，請稍後再試"}), {'Retry-After': '1'}
+        except ClientGone:
+            return None
+        except RenderTimeout:
+            return 504, _json_body({'error': f"產生超過 {self.timeout:g} 秒，已中止"}), {}
+        except batch_composer.JobTooLarge as e:
+            self.counters['too_large'] += 1
+            return 413, _json_body({'error': str(e)}), {}
+        except (ValueError, TypeError) as e:
+            self.counters['bad_request'] += 1
+            return 400, _json_body({'error': str(e)}), {}
+        except Exception as e:
+            self.counters['failed'] += 1
+            return 500, _json_body({'error': f"{type(e).__name__}: {e}"}), {}
+        return 200, ('audio/midi', data), {'X-Queue-Ms': f"{queued * 1000:.1f}",
+                                           'X-Render-Ms': f"{rendered * 1000:.1f}"}
+
+
+async def _result_unless_gone(future, disconnected):
+    """等待 future 的結果，期間每 DISCONNECT_POLL 秒檢查一次客戶端，斷線時引發 ClientGone"""
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL)
+        if done:
+            return future.result()
+        if disconnected is not None and disconnected():
+            raise ClientGone()
+
+
+def _json_body(payload):
+    return 'application/json; charset=utf-8', json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+async def _respond(writer, status, payload, extra_headers=None, close=False):
+    content_type, body = payload
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}",
+             f"Connection: {'close' if close else 'keep-alive'}"]
+    lines += [f"{name}: {value}" for name, value in (extra_headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+
+async def serve(service, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, on_ready=None):
+    """預熱行程池後開始接受連線，直到被取消為止
+
+    unix_path 指定時改為監聽 Unix socket。on_ready 若有提供，會在開始接受連線時以
+    伺服器物件呼叫一次。
+    """
+    await service.start()
+    if unix_path:
+        server = await asyncio.start_unix_server(service.handle, path=unix_path)
+    else:
+        server = await asyncio.start_server(service.handle, host, port)
+    try:
+        async with server:
+            if on_ready:
+                on_ready(server)
+            await server.serve_forever()
+    finally:
+        service.close()
+        if unix_path and os.path.exists(unix_path):
+            os.remove(unix_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MIDI 作曲助手：作曲服務")
+    parser.add_argument('--host', default='127.0.0.1', help="監聽的位址（預設 127.0.0.1）")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"監聽的埠（預設 {DEFAULT_PORT}）")
+    parser.add_argument('--unix', default=None, help="改為監聽此路徑的 Unix socket")
+    parser.add_argument('--workers', type=int, default=None, help="工作行程數（預設為 CPU 核心數）")
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help=f"等待中的請求上限，超過時回應 503（預設 {DEFAULT_MAX_QUEUE}）")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help=f"單一作品的產生期限（秒），超過時回應 504（預設 {DEFAULT_TIMEOUT:g}）")
+    parser.add_argument('--cache', default=None, help="產生結果的快取目錄")
+    parser.add_argument('--cache-max-mb', type=float, default=None,
+                        help="快取大小上限（MB，預設 256）")
+    args = parser.parse_args(argv)
+
+    cache_max_bytes = int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None
+    service = ComposerService(args.workers, args.max_queue, args.cache, cache_max_bytes,
+                              args.timeout)
+
+    def announce(server):
+        where = args.unix or f"http://{args.host}:{args.port}"
+        print(f"作曲服務已就緒：{where}（{service.workers} 個工作行程）", file=sys.stderr, flush=True)
+
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix, announce))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
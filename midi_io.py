@@ -0,0 +1,378 @@
+"""標準 MIDI 檔（SMF）的直接編碼與串流讀取，不經過 music21 的 Score 物件。
+
+事件格式為 (offset, duration, pitches)：offset 與 duration 以四分音符為單位，
+pitches 為 MIDI 音高的序列（單音為長度 1，和弦為多個音）。需要保存整首樂曲時
+使用 NoteArray，以整數 tick 與平行陣列保存每個音符。
+"""
+import heapq
+from array import array
+import mmap
+import struct
+
+# 與 music21 預設相同的解析度，0.5、0.25、0.125 拍與三連音都能整除
+TICKS_PER_QUARTER = 10080
+DEFAULT_VELOCITY = 90
+DEFAULT_TEMPO = 500000  # 每個四分音符的微秒數（120 BPM）
+
+# 打擊樂器專用的第 10 頻道不分配給一般聲部
+_CHANNELS = [ch for ch in range(16) if ch != 9]
+
+
+def channel_for_part(index):
+    """依聲部順序分配 MIDI 頻道（0 起算，跳過打擊樂頻道）"""
+    return _CHANNELS[index % len(_CHANNELS)]
+
+
+def _var_len(value):
+    """編碼 SMF 的可變長度數值"""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def _meta(delta, meta_type, data):
+    return _var_len(delta) + bytes([0xFF, meta_type]) + _var_len(len(data)) + data
+
+
+def _chunk(tag, body):
+    return tag + struct.pack('>I', len(body)) + body
+
+
+def to_ticks(quarter_length, ticks_per_quarter=TICKS_PER_QUARTER):
+    return int(round(quarter_length * ticks_per_quarter))
+
+
+def encode_tempo_track(tempo=DEFAULT_TEMPO, numerator=4, denominator=4):
+    """產生格式 1 的第一軌：拍號與速度"""
+    denominator_power = denominator.bit_length() - 1
+    body = (_meta(0, 0x58, bytes([numerator, denominator_power, 24, 8])) +
+            _meta(0, 0x51, tempo.to_bytes(3, 'big')) +
+            _meta(0, 0x2F, b''))
+    return _chunk(b'MTrk', body)
+
+
+def iter_channel_messages(events, channel=0, program=None, velocity=DEFAULT_VELOCITY,
+                          ticks_per_quarter=TICKS_PER_QUARTER):
+    """將依 offset 排序的事件轉換成 (絕對 tick, MIDI 訊息位元組)，依時間順序產生
+
+    尚未結束的音符以 heap 保存，因此記憶體只與同時發聲的音數有關。
+    """
+    note_on = 0x90 | channel
+    note_off = 0x80 | channel
+    pending = []  # (結束 tick, 音高)
+
+    if program is not None:
+        yield 0, bytes([0xC0 | channel, program & 0x7F])
+
+    for offset, duration, pitches in events:
+        start = to_ticks(offset, ticks_per_quarter)
+        end = max(start, start + to_ticks(duration, ticks_per_quarter))
+        # 先送出在此之前（含同一時間點）結束的音符，避免同音高重疊
+        while pending and pending[0][0] <= start:
+            tick, p = heapq.heappop(pending)
+            yield tick, bytes([note_off, p, 0])
+        for p in pitches:
+            yield start, bytes([note_on, p, velocity])
+            heapq.heappush(pending, (end, p))
+
+    while pending:
+        tick, p = heapq.heappop(pending)
+        yield tick, bytes([note_off, p, 0])
+
+
+def iter_track_bytes(events, channel=0, program=None, name=None,
+                     velocity=DEFAULT_VELOCITY, ticks_per_quarter=TICKS_PER_QUARTER,
+                     piece_size=4096):
+    """將依 offset 排序的事件逐段編碼成音軌內容（不含 MTrk 標頭），每段約 piece_size 位元組"""
+    messages = iter_channel_messages(events, channel, program, velocity, ticks_per_quarter)
+    return _iter_message_bytes(messages, name, piece_size)
+
+
+def _iter_message_bytes(messages, name=None, piece_size=4096):
+    """將依時間排序的 (絕對 tick, 訊息位元組) 以相對時間逐段編碼"""
+    if name:
+        yield _meta(0, 0x03, name.encode('utf-8'))
+    last_tick = 0
+    out = bytearray()
+    for tick, message in messages:
+        out += _var_len(tick - last_tick)
+        out += message
+        last_tick = tick
+        if len(out) >= piece_size:
+            yield bytes(out)
+            out.clear()
+    out += _meta(0, 0x2F, b'')
+    yield bytes(out)
+
+
+def merge_messages(parts, ticks_per_quarter=TICKS_PER_QUARTER):
+    """合併多個聲部的訊息，依時間順序產生 (絕對 tick, MIDI 訊息位元組)
+
+    parts 的格式與 write_smf_stream 相同；同一時間點依聲部順序排列，
+    頻道分配也與寫出的 SMF 一致。
+    """
+    streams = [iter_channel_messages(events, channel_for_part(idx), program,
+                                     ticks_per_quarter=ticks_per_quarter)
+               for idx, (events, program, name) in enumerate(parts)]
+    return heapq.merge(*streams, key=lambda message: message[0])
+
+
+def encode_track(events, channel=0, program=None, name=None,
+                 velocity=DEFAULT_VELOCITY, ticks_per_quarter=TICKS_PER_QUARTER):
+    """將事件編碼成完整的 MTrk 區塊"""
+    body = b''.join(iter_track_bytes(events, channel, program, name, velocity, ticks_per_quarter))
+    return _chunk(b'MTrk', body)
+
+
+def encode_smf(track_chunks, ticks_per_quarter=TICKS_PER_QUARTER):
+    """組合 MThd 與已編碼的 MTrk 區塊，回傳格式 1 的 SMF 位元組"""
+    header = _chunk(b'MThd', struct.pack('>HHH', 1, len(track_chunks), ticks_per_quarter))
+    return header + b''.join(track_chunks)
+
+
+def write_smf_stream(fp, parts, tempo=DEFAULT_TEMPO, ticks_per_quarter=TICKS_PER_QUARTER,
+                     chunk_size=1 << 16):
+    """逐軌串流寫出格式 1 的 SMF，回傳寫入的位元組數
+
+    parts 為 (事件, program, 音軌名稱) 的序列，事件可以是產生器，依序佔用第 2 軌之後
+    的音軌。每軌只緩衝 chunk_size 位元組就寫出，寫完後再回填 MTrk 的長度，
+    因此 fp 必須可以 seek；記憶體用量與樂曲長度無關。
+    """
+    tracks = (iter_track_bytes(events, channel_for_part(idx), program, name,
+                               ticks_per_quarter=ticks_per_quarter)
+              for idx, (events, program, name) in enumerate(parts))
+    return _write_tracks(fp, tracks, len(parts), tempo, ticks_per_quarter, chunk_size)
+
+
+def _write_tracks(fp, tracks, track_count, tempo, ticks_per_quarter, chunk_size):
+    """寫出 MThd、速度軌與 track_count 個以位元組片段產生的音軌，回傳寫入的位元組數"""
+    written = fp.write(_chunk(b'MThd', struct.pack('>HHH', 1, track_count + 1, ticks_per_quarter)))
+    written += fp.write(encode_tempo_track(tempo))
+    for pieces in tracks:
+        length_pos = fp.tell() + 4
+        written += fp.write(b'MTrk\x00\x00\x00\x00')
+        length = 0
+        buffer = bytearray()
+        for piece in pieces:
+            buffer += piece
+            if len(buffer) >= chunk_size:
+                length += fp.write(buffer)
+                buffer.clear()
+        length += fp.write(buffer)
+        end_pos = fp.tell()
+        fp.seek(length_pos)
+        fp.write(struct.pack('>I', length))
+        fp.seek(end_pos)
+        written += length
+    return written
+
+
+def write_smf(path, parts, tempo=DEFAULT_TEMPO, ticks_per_quarter=TICKS_PER_QUARTER):
+    """將多個聲部寫成格式 1 的 SMF 檔，回傳寫入的位元組數（參數同 write_smf_stream）"""
+    with open(path, 'wb') as f:
+        return write_smf_stream(f, parts, tempo, ticks_per_quarter)
+
+
+# ========== 緊湊的音符表 ==========
+
+class NoteArray:
+    """以平行陣列保存整首樂曲的音符：開始 tick、長度 tick、音高與力度
+
+    每個音符佔 14 位元組，不為每個音符建立物件；和弦以同一 tick、同一長度的
+    多個音符表示。音符依音軌順序連續存放，spans 記錄各音軌的 (起始列, 結束列)；
+    各音軌的 program 與名稱另外保存在 programs、names。
+    """
+    __slots__ = ('ticks', 'durations', 'pitches', 'velocities', 'spans',
+                 'programs', 'names', 'ticks_per_quarter')
+
+    def __init__(self, ticks_per_quarter=TICKS_PER_QUARTER):
+        self.ticks = array('q')
+        self.durations = array('i')
+        self.pitches = array('B')
+        self.velocities = array('B')
+        self.spans = []
+        self.programs = []
+        self.names = []
+        self.ticks_per_quarter = ticks_per_quarter
+
+    @classmethod
+    def from_parts(cls, parts, velocity=DEFAULT_VELOCITY, ticks_per_quarter=TICKS_PER_QUARTER):
+        """由 (事件, program, 音軌名稱) 的聲部列表建立，事件可以是產生器"""
+        notes = cls(ticks_per_quarter)
+        for events, program, name in parts:
+            notes.extend_events(notes.add_track(program, name), events, velocity)
+        return notes
+
+    def __len__(self):
+        return len(self.ticks)
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in
+                   (self.ticks, self.durations, self.pitches, self.velocities))
+
+    def add_track(self, program=0, name=None):
+        """新增音軌，回傳音軌編號；之後加入的音符都屬於這個音軌"""
+        self.programs.append(program)
+        self.names.append(name)
+        self.spans.append((len(self), len(self)))
+        return len(self.programs) - 1
+
+    def append(self, track, tick, duration, pitch, velocity=DEFAULT_VELOCITY):
+        """加入一個音符；只能加到最後新增的音軌"""
+        if track != len(self.spans) - 1:
+            raise ValueError("音符只能加入最後新增的音軌")
+        self.ticks.append(tick)
+        self.durations.append(duration)
+        self.pitches.append(pitch)
+        self.velocities.append(velocity)
+        self.spans[track] = (self.spans[track][0], len(self))
+
+    def extend_events(self, track, events, velocity=DEFAULT_VELOCITY):
+        """將 (offset, duration, pitches) 事件換算成 tick 後加入音軌"""
+        tpq = self.ticks_per_quarter
+        for offset, duration, pitches in events:
+            tick = to_ticks(offset, tpq)
+            length = max(0, to_ticks(duration, tpq))
+            for p in pitches:
+                self.append(track, tick, length, p, velocity)
+
+    def iter_events(self, track):
+        """依 (offset, duration, pitches) 格式逐一產生音軌的事件，同時開始且等長的音合併成和弦"""
+        tpq = self.ticks_per_quarter
+        ticks, durations = self.ticks, self.durations
+        i, stop = self.spans[track]
+        while i < stop:
+            tick, duration = ticks[i], durations[i]
+            j = i + 1
+            while j < stop and ticks[j] == tick and durations[j] == duration:
+                j += 1
+            yield tick / tpq, duration / tpq, tuple(self.pitches[i:j])
+            i = j
+
+
+# ========== 讀取 ==========
+
+class SmfFile:
+    """以 mmap 讀取 SMF：開啟時只解析標頭與各軌位置，事件在迭代時才逐一解碼
+
+    檔案內容不會整個讀進記憶體，非常大的檔案也只佔用固定的記憶體。
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"不是 MIDI 檔：{path}")
+        try:
+            self._parse_header(path)
+        except Exception:
+            self.close()
+            raise
+
+    def _parse_header(self, path):
+        m = self._map
+        if len(m) < 14 or m[0:4] != b'MThd':
+            raise ValueError(f"不是 MIDI 檔：{path}")
+        header_length = struct.unpack('>I', m[4:8])[0]
+        self.format, track_count, division = struct.unpack('>HHH', m[8:14])
+        if division & 0x8000:
+            raise ValueError("不支援 SMPTE 時間格式的 MIDI 檔")
+        self.ticks_per_quarter = division
+        # 依序找出 MTrk 區塊，略過不認得的區塊；長度超出檔案時截斷到檔尾
+        self.tracks = []
+        pos = 8 + header_length
+        while pos + 8 <= len(m) and len(self.tracks) < track_count:
+            tag = m[pos:pos + 4]
+            length = struct.unpack('>I', m[pos + 4:pos + 8])[0]
+            if tag == b'MTrk':
+                self.tracks.append((pos + 8, min(pos + 8 + length, len(m))))
+            pos += 8 + length
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_events(self, track):
+        """逐一解碼第 track 軌的事件，產生 (絕對 tick, 狀態位元組, 資料1, 資料2)
+
+        通道訊息的資料為整數（只有一個資料位元組時資料2 為 0）；meta 事件的
+        狀態位元組為 0xFF，資料1 為類型、資料2 為內容位元組。SysEx 會被略過。
+        """
+        m = self._map
+        pos, end = self.tracks[track]
+
+        def truncated():
+            return ValueError(f"第 {track} 軌在位置 {pos} 截斷或損壞")
+
+        def read_varlen():
+            nonlocal pos
+            value = 0
+            while True:
+                if pos >= end:
+                    raise truncated()
+                byte = m[pos]
+                pos += 1
+                value = (value << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    return value
+
+        tick = 0
+        running = None
+        while pos < end:
+            # 可變長度的 delta time
+            tick += read_varlen()
+            if pos >= end:
+                raise truncated()
+
+            status = m[pos]
+            if status >= 0x80:
+                pos += 1
+            elif running is None:
+                raise ValueError(f"第 {track} 軌在位置 {pos} 缺少狀態位元組")
+            else:
+                status = running
+
+            if status == 0xFF or status in (0xF0, 0xF7):
+                meta_type = None
+                if status == 0xFF:
+                    if pos >= end:
+                        raise truncated()
+                    meta_type = m[pos]
+                    pos += 1
+                length = read_varlen()
+                if pos + length > end:
+                    raise truncated()
+                data = m[pos:pos + length]
+                pos += length
+                running = None
+                if meta_type is not None:
+                    yield tick, 0xFF, meta_type, data
+                    if meta_type == 0x2F:
+                        return
+                continue
+
+            running = status
+            size = 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+            if pos + size > end:
+                raise truncated()
+            data1 = m[pos]
+            data2 = m[pos + 1] if size == 2 else 0
+            pos += size
+            yield tick, status, data1, data2
+
+    def iter_note_ons(self, track):
+        """產生第 track 軌的發聲事件 (絕對 tick, 頻道, 音高)；力度為 0 的 note on 視為 note off"""
+        for tick, status, data1, data2 in self.iter_events(track):
+            if status & 0xF0 == 0x90 and data2 > 0:
+                yield tick, status & 0x0F, data1
@@ -1,21 +1,159 @@
 import curses
-from music21 import *
+import importlib
+import io
 import math
 import os
-import copy
+import secrets
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
 from wcwidth import wcswidth
+import midi_io
+import render_cache
+
+class _LazyModule:
+    """第一次取用屬性時才匯入對應的 music21 子模組，讓開始畫面不必等待 music21 載入"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module('music21.' + self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+note = _LazyModule('note')
+chord = _LazyModule('chord')
+stream = _LazyModule('stream')
+instrument = _LazyModule('instrument')
+analysis = _LazyModule('analysis')
+interval = _LazyModule('interval')
+pitch = _LazyModule('pitch')
+meter = _LazyModule('meter')
+midi_translate = _LazyModule('midi.translate')
+
+def preload_music21():
+    """立即載入 music21 與所有樂器物件（批次工作行程等需要預熱的場合使用）"""
+    for module in (note, chord, stream, instrument, analysis, interval, pitch, meter,
+                   midi_translate):
+        module._load()
+    for name in AVAILABLE_INSTRUMENTS:
+        AVAILABLE_INSTRUMENTS[name]
 
 def str_width(s):
     """計算字串在終端機中的實際寬度"""
     return wcswidth(str(s))
 
+# ========== 音名與 MIDI 值轉換 ==========
+
+# music21 對 MIDI 值預設使用的拼法
+_PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+_STEP_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_ACCIDENTAL_ALTERS = {'': 0, '#': 1, '##': 2, '-': -1, '--': -2, 'b': -1}
+
+def _build_note_tables():
+    """預先計算 0~127 的音名，以及所有接受的拼法對應的 MIDI 值（與 music21 的解析一致）"""
+    midi_names = []
+    for midi_val in range(128):
+        octave = midi_val // 12 - 1
+        name = _PITCH_CLASS_NAMES[midi_val % 12]
+        # music21 對第 -1 八度只輸出音名，不附八度
+        midi_names.append(name if octave < 0 else f"{name}{octave}")
+    
+    name_to_midi = {}
+    for step, pitch_class in _STEP_PITCH_CLASSES.items():
+        for letter in (step, step.lower()):
+            for accidental, alter in _ACCIDENTAL_ALTERS.items():
+                # 未指定八度時 music21 預設為第 4 八度
+                for octave in [''] + [str(o) for o in range(10)]:
+                    midi_val = 12 * (int(octave or 4) + 1) + pitch_class + alter
+                    if 0 <= midi_val <= 127:
+                        name_to_midi[letter + accidental + octave] = midi_val
+    return midi_names, name_to_midi
+
+_MIDI_NAMES, _NAME_TO_MIDI = _build_note_tables()
+_conversion_stats = {'hits': 0, 'misses': 0}
+
+@lru_cache(maxsize=1024)
+def _parse_note_name(note_name):
+    """表外的拼法（例如微分音）交給 music21 解析；結果超出 MIDI 0~127 時拋出 ValueError"""
+    parsed = pitch.Pitch(note_name)
+    if not 0 <= parsed.ps <= 127:
+        raise ValueError(f"音名超出 MIDI 範圍：{note_name}")
+    return parsed.midi
+
+def note_name_to_midi(note_name):
+    """音名（如 C4、F#3、Bb2、E-4）轉 MIDI 值，無法解析時拋出 music21 的例外
+
+    selected_notes 的格子也可以直接是 MIDI 值（0~11 沒有 music21 能解析回來的音名），
+    此時原樣傳回。
+    """
+    midi_val = _NAME_TO_MIDI.get(note_name)
+    if midi_val is None:
+        if isinstance(note_name, int) and not isinstance(note_name, bool):
+            if not 0 <= note_name <= 127:
+                raise ValueError(f"MIDI 值超出範圍：{note_name}")
+            _conversion_stats['hits'] += 1
+            return note_name
+        _conversion_stats['misses'] += 1
+        return _parse_note_name(note_name)
+    _conversion_stats['hits'] += 1
+    return midi_val
+
+def midi_to_note_name(midi_val):
+    """MIDI 值轉音名（含八度），拼法與 music21 的 nameWithOctave 相同
+
+    第 -1 八度（0~11）只有音名、不附八度，轉回 MIDI 值時會變成第 4 八度；
+    要放進 selected_notes 時請用 midi_to_cell。
+    """
+    if not 0 <= midi_val <= 127:
+        raise ValueError(f"MIDI 值超出範圍：{midi_val}")
+    _conversion_stats['hits'] += 1
+    return _MIDI_NAMES[midi_val]
+
+def midi_to_cell(midi_val):
+    """MIDI 值轉成 selected_notes 的格子：12~127 使用音名，0~11 保留 MIDI 值"""
+    return midi_to_note_name(midi_val) if midi_val >= 12 else midi_val
+
+def conversion_stats():
+    """回傳音名轉換的命中/未命中次數，以及表外快取的大小"""
+    return {'hits': _conversion_stats['hits'], 'misses': _conversion_stats['misses'],
+            'cached': _parse_note_name.cache_info().currsize}
+
+def reset_conversion_stats():
+    _conversion_stats['hits'] = 0
+    _conversion_stats['misses'] = 0
+
 # ========== 音樂生成核心 ==========
 
+# 產生器版本：任何會改變輸出 MIDI 內容的修改都要遞增，讓舊的快取失效
+GENERATOR_VERSION = 3
+
 C_MAJOR = [60, 62, 64, 65, 67, 69, 71, 72]
 G_MAJOR = [67, 69, 71, 72, 74, 76, 78, 79]
 
 # 音高修正
+def _scale_key(scale):
+    """去除重複的音（保留第一次出現的順序），查表結果不變，快取也不會因旋律不同而各存一份"""
+    return tuple(dict.fromkeys(scale))
+
+@lru_cache(maxsize=256)
+def _snap_table(scale):
+    """預先算好 MIDI 0~127 在音階中最接近的音（距離相同時取音階中排在前面的音）
+
+    scale 須先經 _scale_key 正規化。
+    """
+    return tuple(min(scale, key=lambda s: abs(v - s)) for v in range(128))
+
 def fix_the_note(scale_list, note_val):
+    if isinstance(note_val, int) and 0 <= note_val < 128:
+        return _snap_table(_scale_key(scale_list))[note_val]
     return min(scale_list, key=lambda s: abs(note_val - s))
 
 def transpose_the_melody(note_list, transposition):
@@ -25,61 +163,210 @@ def transpose_the_melody(note_list, transposition):
 def generate_melody(num_sequence, the_scale, variation=0, transpose=0):
     note_list = []
     duration_list = []
+    table = _snap_table(_scale_key(the_scale))
     for d in num_sequence:
         note_pitch = d + 60 + transpose
-        note_list.append(fix_the_note(the_scale, note_pitch))
+        if isinstance(note_pitch, int) and 0 <= note_pitch < 128:
+            note_list.append(table[note_pitch])
+        else:
+            note_list.append(fix_the_note(the_scale, note_pitch))
         if d == 0:
             duration = 1  # 將原本的 2 改為 1
         else:
-            duration = d * 0.25 if variation == 1 else d * 0.125  # 將 0.5 改為 0.25，0.25 改為 0.125
+            # 低於中央C的音符 d 為負值，時值取絕對值以免產生負的時值
+            duration = abs(d) * 0.25 if variation == 1 else abs(d) * 0.125  # 將 0.5 改為 0.25，0.25 改為 0.125
         duration_list.append(duration)
     if duration_list:
         duration_list[-1] = 2  # 將原本的 4 改為 2，讓最後的音符也相應縮短
     note_list = transpose_the_melody(note_list, 12)
     return note_list, duration_list
 
-def generate_extended_melody(selected_notes, num_measures=4):
-    # 從使用者選擇的音符建立音符序列和音階
+def generate_melody_batch(sequences, the_scale, variation=0, transpose=0):
+    """generate_melody 的 NumPy 版本，一次處理多條等長的序列
+
+    sequences 為 (序列數, 長度) 的整數陣列，回傳 (音高, 時值) 兩個同形狀的陣列，
+    每一列與對同一條序列呼叫 generate_melody 的結果相同。
+    """
+    import numpy as np
+    seqs = np.asarray(sequences, dtype=np.int64)
+    if seqs.ndim != 2:
+        raise ValueError("sequences 必須是二維陣列（序列數, 長度）")
+    scale = np.asarray(the_scale, dtype=np.int64)
+    table = np.asarray(_snap_table(_scale_key(the_scale)), dtype=np.int64)
+    
+    pitches = seqs + 60 + transpose
+    in_range = (pitches >= 0) & (pitches < 128)
+    notes = table[np.where(in_range, pitches, 0)]
+    if not in_range.all():
+        # 超出查表範圍的少數音高逐一比較距離，argmin 同樣取排在前面的音
+        outside = pitches[~in_range]
+        notes[~in_range] = scale[np.abs(outside[:, None] - scale[None, :]).argmin(axis=1)]
+    
+    step = 0.25 if variation == 1 else 0.125
+    durations = np.where(seqs == 0, 1.0, np.abs(seqs) * step)
+    if durations.shape[1]:
+        durations[:, -1] = 2
+    return notes + 12, durations
+
+def _melody_material(selected_notes):
+    """從使用者選擇的音符建立相對音高序列和音階"""
     user_notes = []
     scale = []
     
     for row in selected_notes:
         for note_name in row:
-            if note_name:
-                note_obj = note.Note(note_name)
-                user_notes.append(note_obj.pitch.midi - 60)  # 轉換為相對音高
-                scale.append(note_obj.pitch.midi)
+            if note_name is not None:
+                midi_val = note_name_to_midi(note_name)
+                user_notes.append(midi_val - 60)  # 轉換為相對音高
+                scale.append(midi_val)
     
     if not scale:
         scale = C_MAJOR  # 如果沒有選擇音符，使用 C 大調
-        user_notes = [0, 2, 4, 5, 7]  # 使用簡單的音階    # 生成主要段落
-    notes_A, durs_A = generate_melody(user_notes, scale, variation=0, transpose=0)  # 原始主題
-    
-    # 生成第一個過渡段 - 使用上行音階
-    transition1_notes = user_notes[:3] * 2  # 重複前三個音
-    notes_T1, durs_T1 = generate_melody(transition1_notes, scale, variation=1, transpose=0)
-      # 生成B段 - 保持在相同調性
-    notes_B, durs_B = generate_melody(user_notes, scale, variation=0, transpose=0)
-    
-    # 生成第二個過渡段 - 使用下行音階
-    transition2_notes = list(reversed(user_notes[-3:]))  # 使用最後三個音的反向
-    notes_T2, durs_T2 = generate_melody(transition2_notes, scale, variation=1, transpose=0)
-    
-    # 生成C段 - 使用不同的節奏變化
-    notes_C, durs_C = generate_melody(user_notes[::2], scale, variation=1, transpose=0)  # 使用間隔的音符
+        user_notes = [0, 2, 4, 5, 7]  # 使用簡單的音階
+    return user_notes, scale
+
+# 曲式中各段落的素材與節奏：(從使用者音符取出該段序列的函式, variation)
+# 取出函式只做切片、反轉與重複，套用在索引列表上也能得到各段使用的音符位置
+MELODY_SECTIONS = {
+    'A': (lambda notes: list(notes), 0),                 # 原始主題
+    'T1': (lambda notes: list(notes[:3]) * 2, 1),        # 第一個過渡段：重複前三個音
+    'B': (lambda notes: list(notes), 0),                 # B段：保持在相同調性
+    'T2': (lambda notes: list(reversed(notes[-3:])), 1), # 第二個過渡段：最後三個音的反向
+    'C': (lambda notes: list(notes[::2]), 1),            # C段：使用間隔的音符
+    "A'": (lambda notes: list(reversed(notes)), 1),      # 最後的A段變奏：反向主題
+}
+MELODY_FORM = ('A', 'T1', 'B', 'T2', 'C', "A'")
+
+def iter_melody_sections(selected_notes):
+    """依 A-T1-B-T2-C-A' 的曲式逐段產生 (段落名稱, 音高列表, 時值列表)"""
+    user_notes, scale = _melody_material(selected_notes)
+    for name in MELODY_FORM:
+        select, variation = MELODY_SECTIONS[name]
+        yield (name,) + generate_melody(select(user_notes), scale, variation=variation, transpose=0)
+
+def iter_extended_melody(selected_notes, num_measures=None):
+    """逐段產生延伸旋律
+
+    num_measures 為 None 時只走一次 A-T1-B-T2-C-A' 曲式；指定小節數時會反覆整個
+    曲式，直到填滿 num_measures 個 4/4 小節為止（最後一個音會截短到剛好結束）。
+    每次只保留一個段落，記憶體用量與樂曲長度無關。
+    """
+    if num_measures is None:
+        yield from iter_melody_sections(selected_notes)
+        return
     
-    # 生成最後的A段變奏
-    reversed_notes = list(reversed(user_notes))  # 反向主題
-    notes_Ap, durs_Ap = generate_melody(reversed_notes, scale, variation=1, transpose=0)
+    remaining = num_measures * 4.0
+    while remaining > 0:
+        for name, notes, durations in iter_melody_sections(selected_notes):
+            total = sum(durations)
+            if total >= remaining:
+                # 截斷最後一個段落
+                cut_notes, cut_durations = [], []
+                for pitch_val, duration in zip(notes, durations):
+                    if remaining <= 0:
+                        break
+                    cut_notes.append(pitch_val)
+                    cut_durations.append(min(duration, remaining))
+                    remaining -= duration
+                yield name, cut_notes, cut_durations
+                return
+            remaining -= total
+            yield name, notes, durations
 
+def generate_extended_melody(selected_notes, num_measures=None):
+    """產生完整的延伸旋律，回傳 (音高列表, 時值列表)；num_measures 的意義同 iter_extended_melody"""
+    full_notes = []
+    full_durations = []
     # 合併所有旋律段落：A-T1-B-T2-C-A'的結構
-    full_notes = (notes_A + notes_T1 + notes_B + 
-                 notes_T2 + notes_C + notes_Ap)
-    full_durations = (durs_A + durs_T1 + durs_B + 
-                     durs_T2 + durs_C + durs_Ap)
+    for _, notes, durations in iter_extended_melody(selected_notes, num_measures):
+        full_notes += notes
+        full_durations += durations
     
     return full_notes, full_durations
 
+# 批次產生變奏的結果；pitches 與 durations 的形狀為
+# (種子數, 曲式數, 移調數, variation 設定數, 最長音符數)，第 i 個種子、第 j 個曲式的
+# 有效長度為 lengths[i, j]，之後的位置音高為 -1、時值為 0
+MelodyBatch = namedtuple('MelodyBatch', ['pitches', 'durations', 'lengths'])
+
+def generate_variations_batch(seed_melodies, forms=(MELODY_FORM,), transpositions=(0,),
+                              variations=(None,)):
+    """一次產生多段種子旋律在各種曲式、移調與 variation 設定下的延伸旋律，回傳 MelodyBatch
+
+    seed_melodies 為 selected_notes 格式的旋律列表；forms 為段落名稱序列的列表
+    （名稱見 MELODY_SECTIONS）；transpositions 的意義同 generate_melody 的 transpose；
+    variations 中的 None 表示各段使用曲式預設的 variation，0 或 1 表示全部段落都使用該值。
+    以預設參數產生的每一列與 generate_extended_melody 的結果相同。
+
+    同長度的種子共用段落的索引，整批以 NumPy 查表計算；音高為 int16、時值為 float32。
+    """
+    import numpy as np
+    materials = [_melody_material(m) for m in seed_melodies]
+    transpositions = np.asarray(transpositions, dtype=np.int64)
+    
+    # 各長度、各曲式的 (音符位置, 預設 variation, 段落最後一個音)
+    layouts = {}
+    for user_notes, _ in materials:
+        n = len(user_notes)
+        if n in layouts:
+            continue
+        layouts[n] = []
+        for form in forms:
+            index, section_variation, last = [], [], []
+            for name in form:
+                select, variation = MELODY_SECTIONS[name]
+                section = select(list(range(n)))
+                index += section
+                section_variation += [variation] * len(section)
+                last += [False] * len(section)
+                if section:
+                    last[-1] = True
+            layouts[n].append((np.array(index, dtype=np.intp), np.array(section_variation),
+                               np.array(last, dtype=bool)))
+    width = max((len(layout[0]) for group in layouts.values() for layout in group), default=0)
+    shape = (len(materials), len(forms), len(transpositions), len(variations), width)
+    pitches = np.full(shape, -1, dtype=np.int16)
+    durations = np.zeros(shape, dtype=np.float32)
+    lengths = np.zeros((len(materials), len(forms)), dtype=np.int64)
+    
+    by_length = {}
+    for i, (user_notes, _) in enumerate(materials):
+        by_length.setdefault(len(user_notes), []).append(i)
+    for n, rows in by_length.items():
+        rows = np.array(rows)
+        seeds = np.array([materials[i][0] for i in rows], dtype=np.int64).reshape(len(rows), n)
+        # 各種子以自己的音階查表（同 _snap_table，argmin 同樣取排在前面的音）；
+        # 音階以極大值補齊長度，超出 0~127 的音高逐一比較
+        scale_width = max(len(materials[i][1]) for i in rows)
+        scales = np.full((len(rows), scale_width), 1 << 30, dtype=np.int64)
+        for r, i in enumerate(rows):
+            scales[r, :len(materials[i][1])] = materials[i][1]
+        nearest = np.abs(np.arange(128)[None, :, None] - scales[:, None, :]).argmin(axis=2)
+        tables = np.take_along_axis(scales, nearest, axis=1)
+        
+        for j, (index, section_variation, last) in enumerate(layouts[n]):
+            length = len(index)
+            lengths[rows, j] = length
+            relative = seeds[:, index]  # (種子, 音符)
+            
+            raw = relative[:, None, :] + 60 + transpositions[None, :, None]  # (種子, 移調, 音符)
+            in_range = (raw >= 0) & (raw < 128)
+            notes = np.take_along_axis(tables[:, None, :].repeat(len(transpositions), axis=1),
+                                       np.where(in_range, raw, 0), axis=2)
+            if not in_range.all():
+                seed_idx = np.nonzero(~in_range)[0]
+                outside = raw[~in_range]
+                notes[~in_range] = scales[seed_idx, np.abs(outside[:, None] - scales[seed_idx]).argmin(axis=1)]
+            pitches[rows, j, :, :, :length] = (notes + 12)[:, :, None, :]
+            
+            for v, override in enumerate(variations):
+                section_steps = np.where((section_variation if override is None else override) == 1,
+                                         0.25, 0.125)
+                section_durations = np.where(relative == 0, 1.0, np.abs(relative) * section_steps)
+                section_durations[:, last] = 2
+                durations[rows, j, :, v, :length] = section_durations[:, None, :]
+    return MelodyBatch(pitches, durations, lengths)
+
 # 和弦庫
 chord_library = {
     # 大調和弦
@@ -183,16 +470,199 @@ def generate_accompaniment(chord_notes, pattern_names, total_measures):
     
     return accompaniment_parts
 
-def build_score(selected_notes, pattern_instruments, output_filename):
-    # 生成延伸旋律
-    full_notes, full_durations = generate_extended_melody(selected_notes)
+# ========== 產生過程的統計 ==========
+
+class RenderStats:
+    """記錄單次 build_score 各階段的耗時（秒，不含巢狀階段）與物件數量"""
+    def __init__(self):
+        self.stages = {}
+        self.counters = {'notes': 0, 'chords': 0, 'measures': 0, 'parts': 0, 'bytes_written': 0}
+        self._stack = []  # [階段名稱, 開始時間, 巢狀階段耗時]
+
+    def _enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def _exit(self):
+        name, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    @contextmanager
+    def stage(self, name):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed_events(self, name, events):
+        """包裝事件產生器：產生事件的時間記入 name 階段，並統計單音與和弦數"""
+        iterator = iter(events)
+        while True:
+            self._enter(name)
+            try:
+                event = next(iterator)
+            except StopIteration:
+                self._exit()
+                return
+            self._exit()
+            if len(event[2]) > 1:
+                self.counters['chords'] += 1
+            else:
+                self.counters['notes'] += 1
+            yield event
+
+    def as_dict(self):
+        return {'stages': dict(self.stages), 'counters': dict(self.counters),
+                'total_seconds': sum(self.stages.values())}
+
+class _NullStats:
+    """未開啟統計時使用，所有操作幾乎不花時間"""
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def count(self, name, amount=1):
+        pass
+
+    def timed_events(self, name, events):
+        return events
+
+_NULL_STATS = _NullStats()
+
+class RenderCancelled(Exception):
+    """產生過程被要求取消"""
+
+class RenderProgress(RenderStats):
+    """可由其他執行緒查詢進度並要求取消的 RenderStats
+
+    每進入一個階段都會檢查取消旗標；串流寫出時每個事件都會進入一次階段，
+    因此取消會在下一個事件之前生效，以 RenderCancelled 中止 build_score。
+    """
+    def __init__(self):
+        super().__init__()
+        self.current_stage = None
+        self.parts_started = 0
+        self.position = 0.0  # 目前聲部已產生到的拍數
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def _enter(self, name):
+        if self._cancel.is_set():
+            raise RenderCancelled(name)
+        self.current_stage = name
+        super()._enter(name)
+
+    def timed_events(self, name, events):
+        # 產生器在開始寫出該軌時才執行到這裡
+        self.parts_started += 1
+        self.position = 0.0
+        for event in super().timed_events(name, events):
+            self.position = event[0]
+            yield event
+
+    def fraction(self):
+        """估計完成比例（0~1）：以已寫出的聲部數與目前聲部的拍數計算"""
+        parts = self.counters['parts']
+        beats = self.counters['measures'] * 4
+        if not parts or not beats:
+            return 0.0
+        done = max(0, self.parts_started - 1) + min(1.0, self.position / beats)
+        return min(1.0, done / parts)
+
+# 整體樂曲規劃：移調量、主旋律事件、小節數與和弦進行，供各種輸出方式共用
+ScorePlan = namedtuple('ScorePlan', ['transposition_semitones', 'melody_events',
+                                     'total_measures', 'chord_progression'])
+
+# Aarden-Essen 音級權重，與 music21 analyzeStream(..., 'key') 預設使用的權重相同
+_KEY_PROFILES = {
+    'major': [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587,
+              0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+    'minor': [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362,
+              0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623],
+}
+# 候選調性依 (主音音級, 大小調) 由高到低排列，相關係數相同時與 music21 選出同一個調
+_KEY_CANDIDATES = [(tonic, mode) for tonic in range(11, -1, -1) for mode in ('minor', 'major')]
+_key_profile_matrix = None
+
+def pitch_class_histogram(selected_notes):
+    """統計旋律中每個音級出現的次數（每個音符以一拍計）"""
+    histogram = [0] * 12
+    for row in selected_notes:
+        for note_name in row:
+            if note_name is not None:
+                histogram[note_name_to_midi(note_name) % 12] += 1
+    return histogram
+
+def detect_keys_batch(histograms):
+    """以音級分佈與 24 個調性權重的相關係數判斷調性，一次處理多段旋律
+
+    回傳每段旋律的 (主音音級, 'major' 或 'minor', 相關係數)；分佈全為 0 時為 None。
+    """
+    import numpy as np
+    global _key_profile_matrix
+    if _key_profile_matrix is None:
+        # 每一列為某個主音的權重（旋轉後）並先減去平均值
+        rows = [[_KEY_PROFILES[mode][(j - tonic) % 12] for j in range(12)]
+                for tonic, mode in _KEY_CANDIDATES]
+        profiles = np.array(rows, dtype=float)
+        profiles -= profiles.mean(axis=1, keepdims=True)
+        _key_profile_matrix = (profiles, np.sqrt((profiles ** 2).sum(axis=1)))
+    profiles, profile_norms = _key_profile_matrix
+    
+    hist = np.asarray(histograms, dtype=float).reshape(-1, 12)
+    centered = hist - hist.mean(axis=1, keepdims=True)
+    hist_norms = np.sqrt((centered ** 2).sum(axis=1))
+    denominators = hist_norms[:, None] * profile_norms[None, :]
+    top = centered @ profiles.T
+    correlations = np.divide(top, denominators, out=np.zeros_like(top), where=denominators != 0)
+    best = correlations.argmax(axis=1)
+    
+    results = []
+    for row, idx in enumerate(best.tolist()):
+        if not hist[row].any():
+            results.append(None)
+        else:
+            tonic, mode = _KEY_CANDIDATES[idx]
+            results.append((tonic, mode, float(correlations[row, idx])))
+    return results
+
+def detect_key(selected_notes):
+    """判斷單段旋律的調性，回傳 (主音音級, 大小調, 相關係數)，沒有音符時回傳 None"""
+    return detect_keys_batch([pitch_class_histogram(selected_notes)])[0]
+
+def analyze_key(selected_notes, key_method='builtin'):
+    """分析主旋律的調性，回傳 (主音音級, 'major' 或 'minor', 移調到 C 所需的半音數)
+
+    key_method 為 'builtin' 時使用內建的調性判斷；為 'music21' 時改用
+    music21 的 analyzeStream，可用來驗證內建結果。沒有音符時視為 C 大調。
+    """
+    if key_method == 'builtin':
+        detected = detect_key(selected_notes)
+        if not detected:
+            return 0, 'major', 0
+        # 主音（第 4 八度）移到中央 C 的半音數
+        return detected[0], detected[1], -detected[0]
+    if key_method != 'music21':
+        raise ValueError(f"未知的調性分析方式：{key_method}")
     
-    # 分析主旋律的調性
     melody_notes = []
     for row in selected_notes:
         for note_name in row:
-            if note_name:
-                n = note.Note(note_name)
+            if note_name is not None:
+                n = note.Note(midi=note_name) if isinstance(note_name, int) else note.Note(note_name)
                 melody_notes.append(n)
                 
     # 檢測主旋律的調性和移調量
@@ -201,196 +671,924 @@ def build_score(selected_notes, pattern_instruments, output_filename):
         measure = stream.Measure()
         for n in melody_notes:
             measure.append(n)
-              # 分析調性
+        # 分析調性
         key_analysis = analysis.discrete.analyzeStream(measure, 'key')
         if key_analysis:
             transposition_interval = interval.Interval(key_analysis.tonic, pitch.Pitch('C'))
-            transposition_semitones = transposition_interval.semitones
-        else:
-            transposition_semitones = 0
-    else:
-        transposition_semitones = 0
-      # 主旋律部分
-    melody = stream.Stream()
-    melody.insert(0, meter.TimeSignature('4/4'))
-    
-    # 設定當前時間位置
+            mode = 'minor' if key_analysis.mode == 'minor' else 'major'
+            return key_analysis.tonic.pitchClass, mode, transposition_interval.semitones
+    return 0, 'major', 0
+
+# ---- 和弦表：12 個根音 × 各種和弦，每個和弦有原位、第一、第二轉位三種配置
+_ROOT_NAMES = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+# 和弦組成音相對根音的半音數
+_CHORD_QUALITIES = {
+    '': (0, 4, 7), 'm': (0, 3, 7), 'dim': (0, 3, 6), 'aug': (0, 4, 8), 'sus4': (0, 5, 7),
+    '7': (0, 4, 7, 10), 'maj7': (0, 4, 7, 11), 'm7': (0, 3, 7, 10), 'm7b5': (0, 3, 6, 10),
+}
+_INVERSIONS = 3
+# 最低音放在 F2~E3 之間，原位和弦與 chord_library 的配置相同
+_BASS_LOW = 41
+
+def _build_chord_table():
+    """建立 (和弦名稱列表, {名稱: 索引}, 各和弦的音級遮罩, 各和弦的配置)
+
+    配置皆為四個音：三和弦重複根音，七和弦使用全部四個音；轉位時把最低音移高八度。
+    """
+    names, masks, voicings = [], [], []
+    for root, root_name in enumerate(_ROOT_NAMES):
+        for quality, intervals in _CHORD_QUALITIES.items():
+            tones = list(intervals) if len(intervals) == 4 else list(intervals) + [12]
+            chord_voicings = []
+            for _ in range(_INVERSIONS):
+                bass = _BASS_LOW + (root + tones[0] - _BASS_LOW) % 12
+                chord_voicings.append(tuple(bass + t - tones[0] for t in tones))
+                # 最低音移高八度成為下一個轉位（三和弦的重複根音換成新的最高音）
+                if len(intervals) == 4:
+                    tones = tones[1:] + [tones[0] + 12]
+                else:
+                    tones = tones[1:] + [tones[1] + 12]
+            names.append(root_name + quality)
+            masks.append(sum(1 << ((root + t) % 12) for t in intervals))
+            voicings.append(tuple(chord_voicings))
+    return names, {name: i for i, name in enumerate(names)}, masks, voicings
+
+_CHORD_NAMES, _CHORD_INDEX, _CHORD_MASKS, _CHORD_VOICINGS = _build_chord_table()
+
+# ---- 各調的和弦進行：以 (相對主音的半音數, 和弦種類) 表示，前 8 小節使用基本進行，
+# 之後改用加入七和弦的替代進行，每 8 小節循環一次
+_PROGRESSION_TEMPLATES = {
+    # I-vi-IV-V-I-ii7-V7-I
+    'major': ([(0, ''), (9, 'm'), (5, ''), (7, ''), (0, ''), (2, 'm7'), (7, '7'), (0, '')],
+              [(0, 'maj7'), (9, 'm7'), (5, 'maj7'), (7, '7'), (0, ''), (2, 'm7'), (7, '7'), (0, '')]),
+    # i-VI-iv-V-i-iiø7-V7-i
+    'minor': ([(0, 'm'), (8, ''), (5, 'm'), (7, ''), (0, 'm'), (2, 'm7b5'), (7, '7'), (0, 'm')],
+              [(0, 'm7'), (8, 'maj7'), (5, 'm7'), (7, '7'), (0, 'm'), (2, 'm7b5'), (7, '7'), (0, 'm')]),
+}
+# 同一功能（主、下屬、屬）的和弦可以互相代替
+_FUNCTION_GROUPS = {
+    'major': [[(0, ''), (0, 'maj7'), (9, 'm'), (9, 'm7'), (4, 'm')],
+              [(5, ''), (5, 'maj7'), (2, 'm'), (2, 'm7')],
+              [(7, ''), (7, '7'), (11, 'dim')]],
+    'minor': [[(0, 'm'), (0, 'm7'), (8, ''), (8, 'maj7'), (3, '')],
+              [(5, 'm'), (5, 'm7'), (2, 'dim'), (2, 'm7b5')],
+              [(7, ''), (7, '7'), (11, 'dim')]],
+}
+_TEMPLATE_LENGTH = 8
+
+# ---- 動態規劃的代價
+SUBSTITUTE_COST = 1.0      # 使用代理和弦而非進行表中的和弦
+MISFIT_COST = 1.0          # 每一拍不屬於和弦的旋律音
+VOICE_LEADING_COST = 0.15  # 相鄰兩個配置各聲部移動的每個半音
+INVERSION_COSTS = (0.0, 0.3, 0.5)
+
+# 單一調性的查表資料：
+#   voicing_ids  各狀態的配置編號（和弦索引 × 3 + 轉位）
+#   slot_costs   (2 × 8, 狀態數)：進行表每個位置使用各狀態的代價，不允許的狀態為 inf
+#   misfit       (12, 狀態數)：音級不屬於該狀態的和弦時為 1
+#   transition   (狀態數, 狀態數)：聲部進行的代價
+HarmonyTable = namedtuple('HarmonyTable', ['voicing_ids', 'slot_costs', 'misfit', 'transition'])
+
+def _build_harmony_table(tonic, mode):
+    import numpy as np
+    def chord_index(degree, quality):
+        return _CHORD_INDEX[_ROOT_NAMES[(tonic + degree) % 12] + quality]
+    groups = [[chord_index(*c) for c in group] for group in _FUNCTION_GROUPS[mode]]
+    slots = [chord_index(*c) for template in _PROGRESSION_TEMPLATES[mode] for c in template]
+    
+    chords = sorted({c for group in groups for c in group} | set(slots))
+    voicing_ids = np.array([c * _INVERSIONS + inv for c in chords for inv in range(_INVERSIONS)],
+                           dtype=np.uint16)
+    state_chords = voicing_ids // _INVERSIONS
+    inversion_costs = np.array(INVERSION_COSTS)[voicing_ids % _INVERSIONS]
+    
+    slot_costs = np.full((len(slots), len(voicing_ids)), np.inf)
+    for row, preferred in enumerate(slots):
+        group = next((g for g in groups if preferred in g), [preferred])
+        for c in group:
+            slot_costs[row, state_chords == c] = 0.0 if c == preferred else SUBSTITUTE_COST
+    slot_costs += inversion_costs
+    
+    masks = np.array([_CHORD_MASKS[c] for c in state_chords.tolist()])
+    misfit = ((masks[None, :] >> np.arange(12)[:, None]) & 1 == 0).astype(float)
+    pitches = np.array([_CHORD_VOICINGS[v // _INVERSIONS][v % _INVERSIONS]
+                        for v in voicing_ids.tolist()])
+    transition = np.abs(pitches[:, None, :] - pitches[None, :, :]).sum(axis=2) * VOICE_LEADING_COST
+    return HarmonyTable(voicing_ids, slot_costs, misfit, transition)
+
+@lru_cache(maxsize=None)
+def harmony_tables():
+    """24 個大小調的查表資料 {(主音音級, 大小調): HarmonyTable}，整個行程只建立一次"""
+    return {(tonic, mode): _build_harmony_table(tonic, mode)
+            for tonic in range(12) for mode in ('major', 'minor')}
+
+# 和弦進行以此小節數為一個視窗逐段計算，另外向後多看一個進行表循環再決定視窗內的和弦
+_HARMONY_WINDOW = 64
+_HARMONY_LOOKAHEAD = _TEMPLATE_LENGTH
+
+class ChordProgression(Sequence):
+    """每小節選定的和弦；索引取得和弦名稱
+
+    和弦不會預先算好保存，而是在迭代時以固定大小的視窗逐段計算（見 harmonize），
+    記憶體用量與小節數無關。依序索引時沿用同一個游標，往回索引時從頭重新計算。
+    """
+    def __init__(self, melody_events, key, transposition_semitones, total_measures):
+        self.melody_events = melody_events
+        self.key = key
+        self.transposition_semitones = transposition_semitones
+        self.total_measures = max(0, total_measures)
+        self._cursor = None  # (迭代器, 下一個小節, 上一個配置編號)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cursor'] = None
+        return state
+
+    def __len__(self):
+        return self.total_measures
+
+    def __iter__(self):
+        for v in self.iter_voicing_ids():
+            yield _CHORD_NAMES[v // _INVERSIONS]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return _CHORD_NAMES[self._voicing_id(i) // _INVERSIONS]
+
+    def _voicing_id(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("小節超出範圍")
+        if self._cursor is None or self._cursor[1] > i + 1:
+            self._cursor = (self.iter_voicing_ids(), 0, None)
+        ids, position, v = self._cursor
+        while position <= i:
+            v = next(ids)
+            position += 1
+        self._cursor = (ids, position, v)
+        return v
+
+    def voicing(self, i):
+        """第 i 小節的和弦配置（移調前的 MIDI 音高）"""
+        v = self._voicing_id(i)
+        return _CHORD_VOICINGS[v // _INVERSIONS][v % _INVERSIONS]
+
+    def iter_voicings(self):
+        """逐小節產生和弦配置（移調前的 MIDI 音高）"""
+        for v in self.iter_voicing_ids():
+            yield _CHORD_VOICINGS[v // _INVERSIONS][v % _INVERSIONS]
+
+    def iter_voicing_ids(self):
+        """逐小節產生配置編號（和弦索引 × 3 + 轉位）"""
+        import numpy as np
+        table = harmony_tables()[self.key]
+        states = np.arange(len(table.voicing_ids))
+        blocks = _iter_weight_blocks(self.melody_events, self.transposition_semitones,
+                                     self.total_measures, _HARMONY_LOOKAHEAD)
+        per_window = _HARMONY_WINDOW // _HARMONY_LOOKAHEAD
+        pending = []
+        start = 0
+        previous = None
+        while True:
+            # 視窗本身加上一個向後多看的區塊
+            pending += [b for _, b in zip(range(per_window + 1 - len(pending)), blocks)]
+            if not pending:
+                return
+            weights = np.concatenate(pending)
+            measures = np.arange(start, start + len(weights))
+            slots = measures % _TEMPLATE_LENGTH + np.where(measures >= _TEMPLATE_LENGTH,
+                                                           _TEMPLATE_LENGTH, 0)
+            local = table.slot_costs[slots] + MISFIT_COST * (weights @ table.misfit)
+            
+            # 第一小節接在上一個視窗最後選定的和弦之後
+            cost = local[0] if previous is None else local[0] + table.transition[previous]
+            back = np.zeros((len(weights), len(states)), dtype=np.uint8)
+            for m in range(1, len(weights)):
+                total = cost[:, None] + table.transition
+                back[m] = total.argmin(axis=0)
+                cost = total[back[m], states] + local[m]
+            path = np.empty(len(weights), dtype=np.intp)
+            path[-1] = cost.argmin()
+            for m in range(len(weights) - 1, 0, -1):
+                path[m - 1] = back[m, path[m]]
+            
+            # 還有向後多看的區塊時只確定視窗內的小節，其餘留到下一個視窗重新計算
+            commit = len(pending) - 1 if len(pending) > per_window else len(pending)
+            committed = sum(len(b) for b in pending[:commit])
+            yield from table.voicing_ids[path[:committed]].tolist()
+            previous = path[committed - 1]
+            start += committed
+            pending = pending[commit:]
+
+def _iter_weight_blocks(melody_events, transposition_semitones, total_measures, size):
+    """每 size 小節產生一個 (小節數, 12) 陣列：各小節各音級的旋律拍數，音級換回原調"""
+    import numpy as np
+    events = iter(melody_events or ())
+    event = next(events, None)
+    for start in range(0, total_measures, size):
+        block = np.zeros((min(size, total_measures - start), 12))
+        end = start + len(block)
+        while event is not None:
+            offset, duration, pitches = event
+            measure = int(offset // 4)
+            if measure >= end:
+                break
+            for p in pitches:
+                block[measure - start, (p - transposition_semitones) % 12] += duration
+            event = next(events, None)
+        yield block
+
+def harmonize(melody_events, key, transposition_semitones, total_measures):
+    """以 Viterbi 演算法為每個小節選出和弦與轉位，回傳 ChordProgression
+
+    key 為原曲的 (主音音級, 大小調)，melody_events 為已移調、可重複迭代的主旋律事件
+    （可為 None）。每小節的代價為代理和弦、轉位與不屬於和弦的旋律音拍數，相鄰小節另加
+    聲部進行的代價。計算延遲到迭代時才進行：每次處理 64 小節，再向後多看 8 小節
+    決定視窗內的路徑，下一個視窗接在已確定的最後一個和弦之後；時間與小節數成正比，
+    記憶體只有一個視窗的大小。
+    """
+    return ChordProgression(melody_events, key, transposition_semitones, total_measures)
+
+def _fold_octave(midi_val):
+    """移調後超出 0~127 的音高以八度移回範圍內"""
+    while midi_val < 0:
+        midi_val += 12
+    while midi_val > 127:
+        midi_val -= 12
+    return midi_val
+
+def iter_melody_events(selected_notes, transposition_semitones, num_measures=None):
+    """逐一產生主旋律事件：(開始拍點, 時值, (MIDI 音高,))
+
+    先是使用者選擇的音符（每個一拍），接著是延伸旋律，全部移調到 C 調。
+    指定 num_measures 時整段旋律剛好填滿該小節數。
+    """
+    end_time = num_measures * 4.0 if num_measures is not None else None
     current_time = 0.0
     
     # 加入原始選擇的音符
     for row in selected_notes:
         for col in row:
-            if col:
-                nn = note.Note(col)
-                # 將音符移調到 C 調（如果需要）
-                nn.transpose(transposition_semitones, inPlace=True)
-                nn.quarterLength = 1.0
-                melody.insert(current_time, nn)
+            if col is not None:
+                if end_time is not None and current_time >= end_time:
+                    return
+                duration = 1.0 if end_time is None else min(1.0, end_time - current_time)
+                yield (current_time, duration,
+                       (_fold_octave(note_name_to_midi(col) + transposition_semitones),))
                 current_time += 1.0
     
-    # 加入延伸的旋律（已經根據調性移調）
-    for pitch_val, duration in zip(full_notes, full_durations):
-        nn = note.Note(pitch_val)
-        # 將延伸旋律也移調到相同的調性
-        nn.transpose(transposition_semitones, inPlace=True)
-        nn.quarterLength = duration
-        melody.insert(current_time, nn)
-        current_time += duration
-    
-    # 轉換成包含小節的樂段
-    melody_part = stream.Part()
-    melody_part.insert(0, instrument.Piano())
-    melody_part.append(meter.TimeSignature('4/4'))
-    measures = melody.makeMeasures()
-    for m in measures:
-        melody_part.append(m)
-    melody = melody_part
-    
-    # 計算小節數
-    total_measures = len(melody.measures(0, None))
-    
-    # 分析旋律並自動選擇和弦
-    chords = suggest_chords(selected_notes)
-    recommended_chord = chords[0][0]
-    
-    # 根據旋律的調性建立和弦進行
-    chord_progression = []
-    # 分析主和弦的調性並創建更豐富的和弦進行
-    if recommended_chord.startswith('C'):
-        # C調的和弦進行：I-vi-IV-V-I-II7-V7-I
-        base_progression = ['C', 'Am', 'F', 'G', 'C', 'Dm7', 'G7', 'C']
-    elif recommended_chord.startswith('G'):
-        # G調的和弦進行：I-vi-IV-V-I-II7-V7-I
-        base_progression = ['G', 'Em', 'C', 'D', 'G', 'Am7', 'D7', 'G']
-    elif recommended_chord.startswith('F'):
-        # F調的和弦進行：I-vi-IV-V-I-II7-V7-I
-        base_progression = ['F', 'Dm', 'Bb', 'C', 'F', 'Gm7', 'C7', 'F']
-    else:
-        # 預設使用C調
-        base_progression = ['C', 'Am', 'F', 'G', 'C', 'Dm7', 'G7', 'C']
-    
-    # 為每個小節指定和弦，使用更長的和弦進行
-    for i in range(total_measures):
-        chord_idx = i % len(base_progression)
-        if i > 0 and i % 8 == 0:  # 每8小節後
-            # 加入一些變化，使用替代和弦
-            if base_progression[0] == 'C':
-                base_progression = ['Cmaj7', 'Am7', 'Fmaj7', 'G7', 'C', 'Dm7', 'G7', 'C']
-            elif base_progression[0] == 'G':
-                base_progression = ['Gmaj7', 'Em7', 'Cmaj7', 'D7', 'G', 'Am7', 'D7', 'G']
-            elif base_progression[0] == 'F':
-                base_progression = ['Fmaj7', 'Dm7', 'Bbmaj7', 'C7', 'F', 'Gm7', 'C7', 'F']
-        chord_progression.append(base_progression[chord_idx])
-    
-    # 生成伴奏部分
-    accompaniment_parts = []
-    if pattern_instruments:  # 只有在有選擇琶音模式時才生成伴奏
-        for pattern_name, inst in pattern_instruments:
-            chord_part = stream.Part()
-            chord_part.insert(0, inst)  # 使用選擇的樂器
-            
-            pattern_func = get_arpeggio_patterns()[pattern_name]
-            current_measure = 0
-            
-            while current_measure < total_measures:
-                chord_idx = current_measure // 4
-                current_chord = chord_progression[min(chord_idx, len(chord_progression) - 1)]
-                
-                # 獲取和弦音符並進行移調
-                chord_notes = chord_library[current_chord]
-                transposed_chord_notes = []
-                for chord_note in chord_notes:
-                    n = note.Note(chord_note)
-                    n.transpose(transposition_semitones, inPlace=True)
-                    transposed_chord_notes.append(n.nameWithOctave)
-                
-                note_pattern = pattern_func(transposed_chord_notes, 0.5 if pattern_name != "基本和弦" else 4.0)
-                for note_name, duration in note_pattern:
-                    if isinstance(note_name, list):  # 如果是和弦
-                        ch = chord.Chord(note_name)
-                        ch.quarterLength = duration
-                        chord_part.append(ch)
-                    else:  # 如果是單音
-                        n = note.Note(note_name)
-                        n.quarterLength = duration
-                        chord_part.append(n)
-                
-                current_measure += 1
-            
-            # 確保伴奏與主旋律長度一致
-            chord_part.makeMeasures(inPlace=True)
-            # 如果伴奏部分比主旋律短，補足到相同長度
-            while len(chord_part.measures(0, None)) < total_measures:
-                last_measure = chord_part.measures(0, None)[-1]
-                # 創建一個新的小節並複製原小節的內容
-                new_measure = stream.Measure()
-                for element in last_measure:
-                    if isinstance(element, note.Note):
-                        # 為音符創建新的獨立實例，使用基本屬性
-                        new_note = note.Note()
-                        new_note.pitch = copy.deepcopy(element.pitch)
-                        new_note.quarterLength = element.quarterLength
-                        new_measure.append(new_note)
-                    elif isinstance(element, chord.Chord):
-                        # 為和弦創建新的獨立實例，使用基本屬性
-                        pitches = [copy.deepcopy(p) for p in element.pitches]
-                        new_chord = chord.Chord(pitches)
-                        new_chord.quarterLength = element.quarterLength
-                        new_measure.append(new_chord)
-                chord_part.append(new_measure)
+    # 加入延伸的旋律（也移調到相同的調性）
+    extension_measures = None
+    if end_time is not None:
+        extension_measures = (end_time - current_time) / 4.0
+        if extension_measures <= 0:
+            return
+    for _, notes, durations in iter_extended_melody(selected_notes, extension_measures):
+        for pitch_val, duration in zip(notes, durations):
+            yield (current_time, duration, (_fold_octave(pitch_val + transposition_semitones),))
+            current_time += duration
+
+class MelodyEvents:
+    """可重複迭代的主旋律事件；每次迭代都重新逐段產生，不保留整段旋律"""
+    def __init__(self, selected_notes, transposition_semitones, num_measures=None):
+        self.selected_notes = selected_notes
+        self.transposition_semitones = transposition_semitones
+        self.num_measures = num_measures
+
+    def __iter__(self):
+        return iter_melody_events(self.selected_notes, self.transposition_semitones,
+                                  self.num_measures)
+
+    def total_length(self):
+        """主旋律的總拍數"""
+        end = 0.0
+        for offset, duration, _ in self:
+            end = offset + duration
+        return end
+
+def plan_score(selected_notes, key_method='builtin', num_measures=None, stats=None):
+    """計算輸出前所需的資料，回傳 ScorePlan
+
+    旋律事件與和弦進行都是延遲計算的，輸出時才逐段產生，長篇樂曲也不會一次佔用大量記憶體。
+    stats 為 RenderStats 時會記錄各階段的耗時。
+    """
+    stats = stats or _NULL_STATS
+    with stats.stage('key_analysis'):
+        tonic, mode, transposition_semitones = analyze_key(selected_notes, key_method)
+    melody_events = MelodyEvents(selected_notes, transposition_semitones, num_measures)
+    
+    # 以 4/4 拍計算主旋律佔用的小節數
+    with stats.stage('melody_extension'):
+        if num_measures is None:
+            total_measures = max(1, math.ceil(melody_events.total_length() / 4))
+        else:
+            total_measures = num_measures
+    with stats.stage('chord_progression'):
+        chord_progression = harmonize(melody_events, (tonic, mode), transposition_semitones,
+                                      total_measures)
+    stats.count('measures', total_measures)
+    return ScorePlan(transposition_semitones, melody_events, total_measures, chord_progression)
+
+def iter_accompaniment_events(pattern_name, chord_progression, transposition_semitones,
+                              total_measures):
+    """逐一產生單一伴奏聲部的事件
+
+    每小節依序套用一次琶音模式，和弦與轉位依 chord_progression 逐小節更換；若模式短於一小節
+    （例如上下琶音只有三拍），則以最後的和弦延續模式，補滿到 total_measures 小節。
+    所有拍點都由模式的時值直接累加，時間與事件數成正比。
+    """
+    pattern_func = get_arpeggio_patterns()[pattern_name]
+    current_time = 0.0
+    note_pattern = []
+    current_voicing = None
+    
+    voicings = chord_progression.iter_voicings()
+    voicing = None
+    for current_measure in range(total_measures):
+        # 和弦進行較短時沿用最後的和弦；只在和弦配置改變時重新展開琶音模式
+        voicing = next(voicings, voicing)
+        if voicing != current_voicing:
+            current_voicing = voicing
             
-            accompaniment_parts.append(chord_part)
+            # 獲取移調後的和弦音符
+            transposed_chord_notes = [p + transposition_semitones for p in voicing]
+            note_pattern = [
+                (tuple(midi_val) if isinstance(midi_val, list) else (midi_val,), duration)
+                for midi_val, duration in pattern_func(
+                    transposed_chord_notes, 0.5 if pattern_name != "基本和弦" else 4.0)
+            ]
+        for pitches, duration in note_pattern:
+            yield (current_time, duration, pitches)
+            current_time += duration
     
-    # 合成總譜
-    score = stream.Score()
-    score.insert(0, melody)
-    # 加入所有伴奏聲部
-    for i, part in enumerate(accompaniment_parts):
-        score.insert(i + 1, part)
+    # 確保伴奏與主旋律長度一致
+    end_time = total_measures * 4.0
+    while note_pattern and current_time < end_time:
+        for pitches, duration in note_pattern:
+            if current_time >= end_time:
+                break
+            yield (current_time, min(duration, end_time - current_time), pitches)
+            current_time += duration
+
+def accompaniment_events(pattern_name, chord_progression, transposition_semitones, total_measures):
+    """產生單一伴奏聲部的事件列表"""
+    return list(iter_accompaniment_events(pattern_name, chord_progression,
+                                          transposition_semitones, total_measures))
+
+def render_part_track(pattern_name, chord_progression, transposition_semitones, total_measures,
+                      channel, program, name):
+    """編碼單一伴奏聲部的 MTrk 區塊，回傳 (區塊位元組, 單音數, 和弦數)
+
+    只依賴可序列化的參數，可以交給行程池在其他行程中執行。
+    """
+    counts = [0, 0]
+    def counted(events):
+        for event in events:
+            counts[len(event[2]) > 1] += 1
+            yield event
+    events = iter_accompaniment_events(pattern_name, chord_progression,
+                                       transposition_semitones, total_measures)
+    chunk = midi_io.encode_track(counted(events), channel, program, name)
+    return chunk, counts[0], counts[1]
+
+def _write_parallel(plan, pattern_instruments, fp, executor, stats):
+    """各伴奏聲部交給 executor 同時編碼，再依固定順序合併，結果與逐軌寫出完全相同"""
+    futures = [
+        executor.submit(render_part_track, pattern_name, plan.chord_progression,
+                        plan.transposition_semitones, plan.total_measures,
+                        midi_io.channel_for_part(idx + 1), inst.midiProgram or 0,
+                        inst.instrumentName)
+        for idx, (pattern_name, inst) in enumerate(pattern_instruments)
+    ]
+    # 工作行程編碼伴奏時，主行程同時編碼主旋律
+    with stats.stage('midi_write'):
+        chunks = [midi_io.encode_tempo_track(),
+                  midi_io.encode_track(stats.timed_events('melody_events', plan.melody_events),
+                                       midi_io.channel_for_part(0), 0, 'Piano')]
+    with stats.stage('accompaniment'):
+        for future in futures:
+            chunk, notes, chords = future.result()
+            chunks.append(chunk)
+            stats.count('notes', notes)
+            stats.count('chords', chords)
+    with stats.stage('midi_write'):
+        data = midi_io.encode_smf(chunks)
+        fp.write(data)
+    return len(data)
+
+def score_parts(plan, pattern_instruments, stats=_NULL_STATS):
+    """回傳 midi_io 使用的聲部列表 [(事件, program, 音軌名稱)]
+
+    主旋律固定使用鋼琴，伴奏聲部使用各自選擇的樂器；事件都是產生器，
+    在寫入或播放該軌時才逐一產生。
+    """
+    parts = [(stats.timed_events('melody_events', plan.melody_events), 0, 'Piano')]
+    for pattern_name, inst in pattern_instruments or []:
+        events = iter_accompaniment_events(pattern_name, plan.chord_progression,
+                                           plan.transposition_semitones, plan.total_measures)
+        parts.append((stats.timed_events('accompaniment', events),
+                      inst.midiProgram or 0, inst.instrumentName))
+    return parts
+
+def score_notes(plan, pattern_instruments, stats=_NULL_STATS):
+    """將整首樂曲展開成 midi_io.NoteArray（整數 tick 的平行陣列），聲部順序同 score_parts
+
+    需要保存或多次走訪整首樂曲時使用；直接輸出 MIDI 時仍由 score_parts 串流產生。
+    """
+    return midi_io.NoteArray.from_parts(score_parts(plan, pattern_instruments, stats))
+
+def render_key(selected_notes, pattern_instruments, num_measures=None, writer='native',
+               key_method='builtin'):
+    """產生結果的快取鍵：音符、伴奏模式與樂器、產生器版本與輸出選項的 sha256"""
+    return render_cache.content_key({
+        'version': GENERATOR_VERSION,
+        'notes': [list(row) for row in selected_notes],
+        'parts': [[pattern_name, inst.instrumentName, inst.midiProgram]
+                  for pattern_name, inst in pattern_instruments or []],
+        'measures': num_measures,
+        'writer': writer,
+        'key_method': key_method,
+    })
+
+def build_score(selected_notes, pattern_instruments, output_filename=None, writer='native',
+                key_method='builtin', num_measures=None, stats=None, executor=None, cache=None):
+    """產生樂曲並輸出 MIDI
+
+    output_filename 為路徑時寫入檔案並回傳絕對路徑：先寫到同一目錄的暫存檔，
+    完成後才以 os.replace 換上，多個產生工作同時寫入也不會留下寫到一半的檔案；
+    為可寫入的二進位檔案物件時直接寫入並回傳該物件；為 None 時回傳 MIDI 位元組。
+    writer 為 'native' 時直接編碼 SMF；為 'music21' 時建立完整的 music21 Score 後輸出。
+    key_method 為 'music21' 時以 music21 分析調性（較慢，供驗證用）。
+    num_measures 指定時會反覆旋律曲式，產生剛好該小節數的長篇樂曲；native 輸出
+    會逐軌串流寫入（檔案物件不能 seek 時先在記憶體中組好），記憶體用量不隨長度增加。
+    stats 可傳入 RenderStats，記錄各階段耗時（不含巢狀階段）、音符/和弦/小節/聲部數
+    與寫入的位元組數；未傳入時不做任何記錄。
+    executor 可傳入 concurrent.futures 的 Executor（通常是 ProcessPoolExecutor），
+    native 輸出時各伴奏聲部會在其中同時編碼後依序合併，輸出與逐軌寫出的位元組完全相同；
+    此時各軌會先在記憶體中組好再寫出。
+    cache 可傳入 render_cache.RenderCache：相同輸入（見 render_key）已產生過時直接寫出
+    快取的位元組，不再分析調性與產生事件；未命中時產生後存入快取。
+    """
+    if writer not in ('native', 'music21'):
+        raise ValueError(f"未知的輸出方式：{writer}")
+    arguments = (selected_notes, pattern_instruments, writer, key_method, num_measures,
+                 stats or _NULL_STATS, executor, cache)
+    
+    if output_filename is None:
+        buffer = io.BytesIO()
+        _build_into(buffer, *arguments)
+        return buffer.getvalue()
+    if hasattr(output_filename, 'write'):
+        _build_into(output_filename, *arguments)
+        return output_filename
     
-    # 輸出 MIDI
     output_path = os.path.abspath(output_filename)
-    score.write('midi', fp=output_path)
+    with atomic_output(output_path) as f:
+        _build_into(f, *arguments)
     return output_path
 
+@contextmanager
+def atomic_output(path):
+    """在 path 的目錄中開啟暫存檔供寫入，正常結束時以 os.replace 換上 path
+
+    發生例外（包括取消產生）時刪除暫存檔，原本的 path 保持不變。暫存檔以 0666 建立，
+    由系統套用當時的 umask，權限與一般新檔案相同。
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    while True:
+        tmp_path = os.path.join(directory, f'.{name}.{secrets.token_hex(4)}.tmp')
+        try:
+            fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _build_into(fp, selected_notes, pattern_instruments, writer, key_method, num_measures,
+                stats, executor, cache):
+    """build_score 的本體：將 MIDI 寫入二進位檔案物件 fp"""
+    if cache is not None:
+        key = render_key(selected_notes, pattern_instruments, num_measures, writer, key_method)
+        with stats.stage('cache'):
+            data = cache.get(key)
+        if data is not None:
+            with stats.stage('midi_write'):
+                fp.write(data)
+            stats.count('cache_hits')
+            stats.count('bytes_written', len(data))
+            return
+        stats.count('cache_misses')
+    
+    plan = plan_score(selected_notes, key_method, num_measures, stats)
+    stats.count('parts', 1 + len(pattern_instruments or []))
+    # 要存入快取或 fp 不能 seek 時，先寫到記憶體中
+    seekable = getattr(fp, 'seekable', lambda: False)()
+    target = io.BytesIO() if cache is not None or not seekable else fp
+    stats.count('bytes_written', _write_score(plan, pattern_instruments, target, writer,
+                                              executor, stats))
+    
+    if target is not fp:
+        data = target.getvalue()
+        with stats.stage('midi_write'):
+            fp.write(data)
+        if cache is not None:
+            with stats.stage('cache'):
+                cache.put(key, data)
+
+def _write_score(plan, pattern_instruments, fp, writer, executor, stats):
+    """依輸出方式將 MIDI 寫入 fp，回傳寫入的位元組數"""
+    if writer == 'music21':
+        return _write_music21_score(plan, pattern_instruments, fp, stats)
+    
+    if executor is not None and pattern_instruments:
+        return _write_parallel(plan, pattern_instruments, fp, executor, stats)
+    
+    # 輸出 MIDI（事件產生的時間另外記在 melody_events 與 accompaniment 兩個階段）
+    with stats.stage('midi_write'):
+        return midi_io.write_smf_stream(fp, score_parts(plan, pattern_instruments, stats))
+
+class BackgroundRender:
+    """在背景執行緒中執行 build_score，介面可以隨時查詢進度或取消"""
+    def __init__(self, selected_notes, pattern_instruments, output_filename, cache=None):
+        self.output_filename = output_filename
+        self.cache = cache
+        self.progress = RenderProgress()
+        self.path = None
+        self.error = None
+        self.cancelled = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(selected_notes, pattern_instruments),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, selected_notes, pattern_instruments):
+        try:
+            self.path = build_score(selected_notes, pattern_instruments, self.output_filename,
+                                    stats=self.progress, cache=self.cache)
+        except RenderCancelled:
+            # 寫到一半的暫存檔已由 build_score 刪除
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def cancel(self):
+        self.progress.cancel()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def status_text(self):
+        """一行狀態文字：進度百分比與目前階段，或完成、取消、錯誤的結果"""
+        if not self.done():
+            stage = self.progress.current_stage or "準備中"
+            return f"{self.output_filename} {self.progress.fraction():4.0%}（{stage}）"
+        if self.cancelled:
+            return f"{self.output_filename} 已取消"
+        if self.error is not None:
+            return f"{self.output_filename} 失敗：{self.error}"
+        return f"✓ MIDI已生成: {self.path}"
+
+def _events_to_part(events, inst, total_measures):
+    """將事件直接放進 4/4 拍的各個小節，建立 music21 聲部
+
+    小節邊界由 total_measures 算出，每個事件依開始拍點放入所屬小節，
+    不需要呼叫 makeMeasures，也不必複製小節來補長度。
+    """
+    part = stream.Part()
+    part.insert(0, inst)
+    measures = []
+    for number in range(1, total_measures + 1):
+        m = stream.Measure(number=number)
+        if number == 1:
+            m.insert(0, meter.TimeSignature('4/4'))
+        part.insert((number - 1) * 4.0, m)
+        measures.append(m)
+    
+    for offset, duration, pitches in events:
+        idx = min(int(offset // 4), total_measures - 1)
+        if len(pitches) > 1:  # 如果是和弦
+            element = chord.Chord(list(pitches))
+        else:  # 如果是單音
+            element = note.Note(pitches[0])
+        element.quarterLength = duration
+        measures[idx].insert(offset - idx * 4.0, element)
+    return part
+
+def _write_music21_score(plan, pattern_instruments, fp, stats=_NULL_STATS):
+    """以 music21 建立 Score 並將 MIDI 寫入 fp（保留作為備援與比對用），回傳寫入的位元組數
+
+    樂曲先展開成 NoteArray，只在這裡才轉換成 music21 的物件。
+    """
+    notes = score_notes(plan, pattern_instruments, stats)
+    with stats.stage('music21_build'):
+        # 主旋律部分
+        melody = _events_to_part(notes.iter_events(0), instrument.Piano(), plan.total_measures)
+        
+        # 生成伴奏部分（只有在有選擇琶音模式時才生成伴奏）
+        accompaniment_parts = [
+            _events_to_part(notes.iter_events(track), inst, plan.total_measures)
+            for track, (_, inst) in enumerate(pattern_instruments or [], 1)
+        ]
+        
+        # 合成總譜
+        score = stream.Score()
+        score.insert(0, melody)
+        # 加入所有伴奏聲部
+        for i, part in enumerate(accompaniment_parts):
+            score.insert(i + 1, part)
+    
+    # 輸出 MIDI（與 score.write('midi') 的內容相同）
+    with stats.stage('midi_write'):
+        data = midi_translate.music21ObjectToMidiFile(score, addEndDelay=True).writestr()
+        fp.write(data)
+    return len(data)
+
+# 0~4095 每個 12 位元遮罩中 1 的個數
+_POPCOUNT = [bin(i).count('1') for i in range(1 << 12)]
+# chord_library 的音級遮罩索引：(和弦名稱, 遮罩)，第一次推薦和弦時建立
+_chord_index = None
+
+def pitch_class_mask(note_names):
+    """將一組音名轉成 12 位元的音級遮罩（第 n 位代表音級 n）"""
+    mask = 0
+    for note_name in note_names:
+        if note_name is not None:
+            mask |= 1 << (note_name_to_midi(note_name) % 12)
+    return mask
+
+def _melody_mask(selected_notes):
+    return pitch_class_mask(note_name for row in selected_notes for note_name in row)
+
+def _get_chord_index():
+    global _chord_index
+    if _chord_index is None:
+        names = tuple(chord_library)
+        masks = tuple(pitch_class_mask(chord_library[name]) for name in names)
+        _chord_index = (names, masks)
+    return _chord_index
+
 # 根據音符推薦和弦
 def suggest_chords(selected_notes):
-    # 收集所有不為 None 的音符
-    used_notes = set()
-    for row in selected_notes:
-        for note_name in row:
-            if note_name:
-                n = note.Note(note_name)
-                used_notes.add(n.pitch.name)
-    
-    # 計算每個和弦與旋律音符的匹配程度
-    chord_scores = {}
-    for chord_name, chord_notes in chord_library.items():
-        score = 0
-        chord_note_names = set(note.Note(n).pitch.name for n in chord_notes)
-        # 計算和弦音符與旋律音符的重疊數
-        matching_notes = len(used_notes.intersection(chord_note_names))
-        score += matching_notes * 2
-        chord_scores[chord_name] = score
-    
-    # 根據分數排序和弦
-    sorted_chords = sorted(chord_scores.items(), key=lambda x: x[1], reverse=True)
-    return sorted_chords
+    # 所有不為 None 的音符組成的音級遮罩
+    used_mask = _melody_mask(selected_notes)
+    
+    # 和弦音與旋律音的共同音級數即為匹配程度，每個共同音得 2 分
+    names, masks = _get_chord_index()
+    chord_scores = [(chord_name, _POPCOUNT[used_mask & mask] * 2)
+                    for chord_name, mask in zip(names, masks)]
+    
+    # 根據分數排序和弦（同分時維持 chord_library 的順序）
+    return sorted(chord_scores, key=lambda x: x[1], reverse=True)
+
+def suggest_chords_batch(melodies, top=None):
+    """一次為多段旋律推薦和弦，每段的結果與 suggest_chords 相同
+
+    所有旋律中出現的音名只各轉換一次，再以 NumPy 合成每段的音級遮罩；相同遮罩的旋律
+    只計分排序一次，(和弦數 × 分數) 的結果組合也預先建好。top 可限制每段只回傳前幾名。
+    """
+    import numpy as np
+    names, masks = _get_chord_index()
+    melodies = list(melodies)
+    flat = [note_name for m in melodies for row in m for note_name in row if note_name is not None]
+    lengths = [sum(1 for row in m for note_name in row if note_name is not None)
+               for m in melodies]
+    bits = {name: 1 << (note_name_to_midi(name) % 12) for name in set(flat)}
+    note_bits = np.array([bits[name] for name in flat] + [0], dtype=np.uint16)
+    starts = np.cumsum([0] + lengths[:-1])
+    melody_masks = np.bitwise_or.reduceat(note_bits, starts) if melodies else note_bits[:0]
+    # reduceat 遇到沒有音符的旋律會取到下一個音，須改回 0
+    melody_masks[np.array(lengths) == 0] = 0
+    
+    unique_masks, inverse = np.unique(melody_masks, return_inverse=True)
+    chord_masks = np.array(masks, dtype=np.uint16)
+    popcount = np.array(_POPCOUNT, dtype=np.int32)
+    scores = popcount[unique_masks[:, None] & chord_masks[None, :]] * 2
+    order = np.argsort(-scores, axis=1, kind='stable')
+    if top is not None:
+        order = order[:, :top]
+    pairs = [[(name, 2 * k) for k in range(13)] for name in names]
+    ranked = [[pairs[j][s // 2] for j, s in zip(row, score_row)]
+              for row, score_row in zip(order.tolist(),
+                                        np.take_along_axis(scores, order, axis=1).tolist())]
+    return [list(ranked[k]) for k in inverse.tolist()]
+
+# ========== 匯入 MIDI ==========
+
+# 選擇主旋律時，每個 (軌, 頻道) 最多取樣的音符數，超大的檔案也能很快選出
+_MELODY_SAMPLE_NOTES = 2000
+
+def melody_candidates(smf):
+    """回傳 midi_io.SmfFile 中各 (軌, 頻道) 的 [(軌, 頻道, 取樣音符數, 平均音高)]，略過打擊樂頻道"""
+    totals = {}
+    for track in range(len(smf.tracks)):
+        sampled = 0
+        for tick, channel, midi_val in smf.iter_note_ons(track):
+            if channel == 9:
+                continue
+            entry = totals.setdefault((track, channel), [0, 0])
+            entry[0] += 1
+            entry[1] += midi_val
+            sampled += 1
+            if sampled >= _MELODY_SAMPLE_NOTES:
+                break
+    return [(track, channel, count, total / count)
+            for (track, channel), (count, total) in totals.items()]
+
+def import_melody(path, track=None, channel=None, limit=16, step=None):
+    """從 MIDI 檔取出主旋律，回傳 build_score 使用的 selected_notes 格式
+
+    未指定 track 時，從音符數至少有最多者四分之一的 (軌, 頻道) 中選平均音高最高的；
+    channel 為 None 時使用該軌所有頻道。同時發聲的音只取最高音。
+    step 為 None 時每個發聲各佔一格；指定拍數（如 1.0）時依時間量化，從第一個音起
+    每 step 拍一格，沒有發聲的格為空格。取滿 limit 格就停止解析。
+    """
+    with midi_io.SmfFile(path) as smf:
+        if track is None:
+            candidates = melody_candidates(smf)
+            if not candidates:
+                raise ValueError("MIDI 檔中沒有音符")
+            most = max(c[2] for c in candidates)
+            track, channel = max((c for c in candidates if c[2] * 4 >= most),
+                                 key=lambda c: c[3])[:2]
+        elif not 0 <= track < len(smf.tracks):
+            raise ValueError(f"MIDI 檔只有 {len(smf.tracks)} 軌")
+        
+        step_ticks = step * smf.ticks_per_quarter if step else None
+        cells = []  # 每格的最高音，None 為空格
+        origin = None
+        last_key = None  # 上一個發聲所屬的時間點（或量化後的格）
+        for tick, ch, midi_val in smf.iter_note_ons(track):
+            if ch == 9 or (channel is not None and ch != channel):
+                continue
+            if step_ticks:
+                if origin is None:
+                    origin = tick - tick % step_ticks
+                key = int((tick - origin) // step_ticks)
+                if key >= limit:
+                    break
+                cells.extend([None] * (key + 1 - len(cells)))
+            else:
+                key = tick
+                if key != last_key:
+                    if len(cells) >= limit:
+                        break
+                    cells.append(None)
+            last_key = key
+            if cells[-1] is None or midi_val > cells[-1]:
+                cells[-1] = midi_val
+    
+    if not any(v is not None for v in cells):
+        raise ValueError("選取的音軌中沒有音符")
+    return [[midi_to_cell(v) if v is not None else None] for v in cells]
+
+# ========== 畫面繪製 ==========
+
+class _DirtyCanvas:
+    """只重畫有變動部分的畫面緩衝
+
+    每一幀以 addstr 記錄 (y, x) -> (文字, 屬性)，flush 時與上一幀比較：消失或變短的
+    文字先以空白蓋掉，再寫入有變動（或被空白蓋到）的項目，最後以
+    noutrefresh/doupdate 一次送出，不再每次按鍵都 clear() 整個畫面。
+    """
+    def __init__(self, stdscr):
+        self._stdscr = stdscr
+        self._shown = None  # 已顯示的內容；None 表示下一次要全部重畫
+        self._size = None
+        self._frame = {}
+
+    def begin(self):
+        """開始新的一幀"""
+        self._frame = {}
+
+    def addstr(self, y, x, text, attr=curses.A_NORMAL):
+        self._frame[(y, x)] = (text, attr)
+
+    def invalidate(self):
+        """畫面被其他程式碼改動時呼叫，下一次 flush 會全部重畫"""
+        self._shown = None
+
+    def flush(self):
+        """將本幀與上一幀的差異寫入終端機，回傳實際寫入的項目數"""
+        stdscr = self._stdscr
+        size = stdscr.getmaxyx()
+        if self._shown is None or size != self._size:
+            stdscr.erase()
+            self._shown = {}
+            self._size = size
+
+        blanked = {}  # y -> 被空白蓋掉的 [(起點, 終點)]
+        for (y, x), (text, attr) in self._shown.items():
+            new = self._frame.get((y, x))
+            if new == (text, attr):
+                continue
+            old_width = max(0, str_width(text))
+            if new is None or max(0, str_width(new[0])) < old_width:
+                stdscr.addstr(y, x, ' ' * old_width)
+                blanked.setdefault(y, []).append((x, x + old_width))
+
+        written = 0
+        for (y, x), (text, attr) in self._frame.items():
+            if self._shown.get((y, x)) == (text, attr):
+                end = x + max(0, str_width(text))
+                if not any(start < end and x < stop for start, stop in blanked.get(y, ())):
+                    continue
+            stdscr.addstr(y, x, text, attr)
+            written += 1
+
+        self._shown = self._frame
+        stdscr.noutrefresh()
+        curses.doupdate()
+        return written
+
+class _GridViewport:
+    """長旋律網格的可視範圍：只記錄最上面一行，游標移出範圍時才捲動
+
+    每次只走訪可見的行，重畫與移動的成本和旋律長度無關。
+    """
+    def __init__(self, per_row=8, rows=2):
+        self.per_row = per_row
+        self.rows = rows
+        self.top = 0  # 最上面一行的行號
+
+    def resize(self, rows):
+        self.rows = max(1, rows)
+
+    def follow(self, index):
+        """捲動到第 index 格所在的行可見為止"""
+        row = index // self.per_row
+        if row < self.top:
+            self.top = row
+        elif row >= self.top + self.rows:
+            self.top = row - self.rows + 1
+
+    def page(self, direction, index, length):
+        """向上（-1）或向下（1）翻一頁，回傳游標的新位置"""
+        last_row = (length - 1) // self.per_row
+        self.top = min(max(self.top + direction * self.rows, 0), max(0, last_row - self.rows + 1))
+        index = min(max(index + direction * self.rows * self.per_row, 0), length - 1)
+        self.follow(index)
+        return index
+
+    def visible(self, length):
+        """依序產生可見各行的 (行號, 開始格, 結束格)"""
+        last_row = (length - 1) // self.per_row
+        for row in range(self.top, min(self.top + self.rows, last_row + 1)):
+            yield row, row * self.per_row, min(length, (row + 1) * self.per_row)
+
+# 有背景產生時，按鍵等待的逾時（毫秒），以便定期更新狀態列
+_STATUS_POLL_MS = 100
+
+@contextmanager
+def _polling(stdscr, enabled):
+    """enabled 時讓 getch 逾時返回 -1，離開時恢復成阻塞等待"""
+    if enabled:
+        stdscr.timeout(_STATUS_POLL_MS)
+    try:
+        yield
+    finally:
+        if enabled:
+            stdscr.timeout(-1)
+
+def _fit_width(text, width):
+    """截斷字串使其顯示寬度不超過 width"""
+    while text and str_width(text) > width:
+        text = text[:-1]
+    return text
+
+def _draw_status(canvas, status, height, width):
+    """在最後一行畫出背景產生的狀態"""
+    if status:
+        text = status()
+        if text:
+            canvas.addstr(height - 1, 5, _fit_width(text, width - 6), curses.A_DIM)
 
 def select_chord_screen(stdscr, selected_notes):
     chords = suggest_chords(selected_notes)[:5]  # 只取前五個最適合的和弦
     current_idx = 0
+    canvas = _DirtyCanvas(stdscr)
     
     try:
         while True:
-            stdscr.clear()
+            canvas.begin()
             
             # 顯示標題和操作說明
-            stdscr.addstr(1, 5, "選擇伴奏和弦", curses.A_BOLD)
-            stdscr.addstr(2, 5, "操作說明：", curses.A_NORMAL)
-            stdscr.addstr(3, 5, "上下鍵 = 選擇和弦", curses.A_NORMAL)
-            stdscr.addstr(4, 5, "Enter = 確認選擇", curses.A_NORMAL)
-            stdscr.addstr(6, 5, "最適合的五個和弦（根據旋律自動分析）：", curses.A_BOLD)
+            canvas.addstr(1, 5, "選擇伴奏和弦", curses.A_BOLD)
+            canvas.addstr(2, 5, "操作說明：", curses.A_NORMAL)
+            canvas.addstr(3, 5, "上下鍵 = 選擇和弦", curses.A_NORMAL)
+            canvas.addstr(4, 5, "Enter = 確認選擇", curses.A_NORMAL)
+            canvas.addstr(6, 5, "最適合的五個和弦（根據旋律自動分析）：", curses.A_BOLD)
             
             # 顯示前五個最適合的和弦
             for i, (chord_name, score) in enumerate(chords):
@@ -398,9 +1596,9 @@ def select_chord_screen(stdscr, selected_notes):
                 stars = "★" * min(5, score) if score > 0 else "☆"
                 text = f"{chord_name:<4} {stars:<5}"  # 固定寬度以避免溢位
                 attr = curses.A_REVERSE if i == current_idx else curses.A_NORMAL
-                stdscr.addstr(8 + i, 10, text, attr)
+                canvas.addstr(8 + i, 10, text, attr)
             
-            stdscr.refresh()
+            canvas.flush()
             
             # 處理按鍵輸入
             key = stdscr.getch()
@@ -419,20 +1617,32 @@ def select_chord_screen(stdscr, selected_notes):
         stdscr.refresh()
         stdscr.getch()
         return 'C'  # 返回預設和弦
-def select_notes_screen(stdscr):
-    cols = 16  # 保持16個音符的長度
-    notes = [None] * cols  # 儲存MIDI音符值
+# 音符網格：預設 16 格，最多可以延長到 _MAX_GRID_NOTES 格
+_GRID_NOTES = 16
+_MAX_GRID_NOTES = 10000
+_GRID_TOP = 11
+
+def select_notes_screen(stdscr, status=None):
+    """輸入旋律音符；status 為回傳狀態文字的函式時，會在最後一行持續顯示背景產生進度
+
+    網格每行 8 格，只畫出視窗放得下的行；在最後一格按 → 或批量輸入超過結尾時會延長旋律。
+    """
+    notes = [None] * _GRID_NOTES  # 儲存MIDI音符值
     c = 0  # 當前位置
     input_buffer = ""  # 用於暫存輸入的數字或音名
     bulk_input_mode = False  # 是否處於批量輸入模式
     note_name_mode = False  # 是否處於音名輸入模式
+    import_mode = False  # 是否正在輸入要匯入的 MIDI 檔路徑
+    jump_mode = False  # 是否正在輸入要跳到的位置
+    message = ""  # 匯入結果等提示
+    canvas = _DirtyCanvas(stdscr)
+    viewport = _GridViewport()
     
     def parse_note_name(note_str):
         """將音名轉換為MIDI音高值"""
         try:
             if note_str:
-                n = note.Note(note_str)
-                return n.pitch.midi
+                return note_name_to_midi(note_str)
         except:
             return None
         return None
@@ -440,46 +1650,46 @@ def select_notes_screen(stdscr):
     def draw_screen():
         height, width = stdscr.getmaxyx()
         title = "輸入旋律音符######"  # 在這裡定義title
-        stdscr.clear()
+        canvas.begin()
         
         # 檢查有足夠的空間
         if height < 20 or width < 80:
-            stdscr.addstr(0, 0, "請調整視窗大小（至少需要80x20）")
-            stdscr.refresh()
+            canvas.addstr(0, 0, "請調整視窗大小（至少需要80x20）")
+            canvas.flush()
             return
             
         # 標題和基本操作說明
-        stdscr.addstr(1, 5, title, curses.A_BOLD)
-        stdscr.addstr(2, 5, "基本操作：", curses.A_NORMAL)
-        stdscr.addstr(3, 5, "← → = 移動游標", curses.A_NORMAL)
-        stdscr.addstr(4, 5, "空格 = 切換輸入模式", curses.A_NORMAL)
-        stdscr.addstr(5, 5, "T = 切換批量輸入模式", curses.A_NORMAL)
-        stdscr.addstr(6, 5, "Enter = 確認", curses.A_NORMAL)
-        stdscr.refresh()  # 刷新第一部分
+        canvas.addstr(1, 5, title, curses.A_BOLD)
+        canvas.addstr(2, 5, "基本操作：", curses.A_NORMAL)
+        canvas.addstr(3, 5, "← → ↑ ↓ = 移動游標　PgUp PgDn = 翻頁　Home End = 開頭／結尾", curses.A_NORMAL)
+        canvas.addstr(4, 5, "空格 = 切換輸入模式　J = 跳到指定位置", curses.A_NORMAL)
+        canvas.addstr(5, 5, "T = 切換批量輸入模式　I = 從 MIDI 檔匯入", curses.A_NORMAL)
+        canvas.addstr(6, 5, "Enter = 確認", curses.A_NORMAL)
         
         # 模式說明
         if note_name_mode:
-            stdscr.addstr(7, 5, "【音名輸入模式】", curses.A_BOLD)
-            stdscr.addstr(8, 5, "輸入範例：C4、D4、E4、F4、G4、A4、B4", curses.A_NORMAL)
-            stdscr.addstr(9, 5, "可使用升降記號：C#4、Bb3 等", curses.A_NORMAL)
+            canvas.addstr(7, 5, "【音名輸入模式】", curses.A_BOLD)
+            canvas.addstr(8, 5, "輸入範例：C4、D4、E4、F4、G4、A4、B4", curses.A_NORMAL)
+            canvas.addstr(9, 5, "可使用升降記號：C#4、Bb3 等", curses.A_NORMAL)
         else:
-            stdscr.addstr(7, 5, "【MIDI值輸入模式】", curses.A_BOLD)
-            stdscr.addstr(8, 5, "參考值：60=中央C、67=G4、72=高音C", curses.A_NORMAL)
-            stdscr.addstr(9, 5, "範圍：0-127", curses.A_NORMAL)
-        stdscr.refresh()  # 刷新模式說明
+            canvas.addstr(7, 5, "【MIDI值輸入模式】", curses.A_BOLD)
+            canvas.addstr(8, 5, "參考值：60=中央C、67=G4、72=高音C", curses.A_NORMAL)
+            canvas.addstr(9, 5, "範圍：0-127", curses.A_NORMAL)
         
-        # 顯示音符網格
-        for row in range(2):
-            start_idx = row * 8
-            end_idx = start_idx + 8
-            y_pos = 11 + row * 2
-            stdscr.addstr(y_pos, 5, f"第{row+1}行音符:")
-            stdscr.refresh()  # 刷新每行開頭
+        # 顯示音符網格：只畫可見的行，網格下方保留三行提示與最後一行狀態列
+        viewport.resize(height - _GRID_TOP - 6)
+        viewport.follow(c)
+        total_rows = (len(notes) - 1) // viewport.per_row + 1
+        last_visible = min(viewport.top + viewport.rows, total_rows)
+        canvas.addstr(_GRID_TOP - 1, 5, f"第 {c + 1}/{len(notes)} 格　顯示第 {viewport.top + 1}~"
+                      f"{last_visible} 行，共 {total_rows} 行", curses.A_DIM)
+        for row, start_idx, end_idx in viewport.visible(len(notes)):
+            y_pos = _GRID_TOP + row - viewport.top
+            canvas.addstr(y_pos, 5, f"第{row+1}行音符:")
             
             for i in range(start_idx, end_idx):
                 if notes[i] is not None:
-                    n = note.Note(notes[i])
-                    display = f"[{n.nameWithOctave:3}]"
+                    display = f"[{midi_to_note_name(notes[i]):3}]"
                 else:
                     display = "[   ]"
                 
@@ -487,86 +1697,165 @@ def select_notes_screen(stdscr):
                 if i == c and not bulk_input_mode and input_buffer:
                     display = f"[{input_buffer:3}]"
                 
-                stdscr.addstr(y_pos, 20 + (i - start_idx) * 6, display, attr)
-            stdscr.refresh()  # 刷新每行音符
+                canvas.addstr(y_pos, 20 + (i - start_idx) * 6, display, attr)
         
         # 顯示當前狀態
-        if bulk_input_mode:
-            stdscr.addstr(15, 5, "批量輸入模式（用空格分隔多個音符）", curses.A_BOLD)
-            stdscr.addstr(16, 5, f"> {input_buffer}")
+        info_y = _GRID_TOP + viewport.rows + 1
+        if import_mode:
+            canvas.addstr(info_y, 5, "匯入 MIDI 檔（輸入路徑後按 Enter，ESC 取消）", curses.A_BOLD)
+            canvas.addstr(info_y + 1, 5, f"> {input_buffer}")
+        elif jump_mode:
+            canvas.addstr(info_y, 5, f"跳到第幾格（1~{_MAX_GRID_NOTES}，超過結尾時延長旋律；ESC 取消）",
+                          curses.A_BOLD)
+            canvas.addstr(info_y + 1, 5, f"> {input_buffer}")
+        elif bulk_input_mode:
+            canvas.addstr(info_y, 5, "批量輸入模式（用空格分隔多個音符）", curses.A_BOLD)
+            canvas.addstr(info_y + 1, 5, f"> {input_buffer}")
         elif input_buffer:
-            stdscr.addstr(15, 5, f"正在輸入: {input_buffer}", curses.A_BOLD)
+            canvas.addstr(info_y, 5, f"正在輸入: {input_buffer}", curses.A_BOLD)
+        if message:
+            canvas.addstr(info_y + 2, 5, _fit_width(message, width - 6))
         
-        stdscr.refresh()  # 最後刷新一次
+        _draw_status(canvas, status, height, width)
+        canvas.flush()  # 整幀一次送出
     
     try:
-        while True:
-            draw_screen()
-            key = stdscr.getch()
-            
-            if bulk_input_mode:
-                if key == ord('\n') or key == 10:  # Enter鍵
-                    try:
-                        inputs = input_buffer.split()
-                        pos = c
-                        for val in inputs:
-                            if note_name_mode:
-                                midi_val = parse_note_name(val)
-                            else:
-                                midi_val = int(val)
-                            if midi_val is not None and 0 <= midi_val <= 127 and pos < cols:
-                                notes[pos] = midi_val
-                                pos = (pos + 1) % cols
+        with _polling(stdscr, status is not None):
+            while True:
+                draw_screen()
+                key = stdscr.getch()
+                
+                if import_mode:
+                    if key == ord('\n') or key == 10:  # Enter鍵
+                        path = input_buffer.strip()
+                        try:
+                            imported = import_melody(path, limit=_MAX_GRID_NOTES)
+                            notes = [note_name_to_midi(row[0]) if row[0] is not None else None
+                                     for row in imported]
+                            notes += [None] * (_GRID_NOTES - len(notes))
+                            c = 0
+                            message = f"已從 {path} 匯入 {sum(n is not None for n in notes)} 個音符"
+                        except (OSError, ValueError) as e:
+                            message = f"無法匯入：{e}"
+                        import_mode = False
+                        input_buffer = ""
+                    elif key == 27:  # ESC
+                        import_mode = False
+                        input_buffer = ""
+                    elif key == ord('\b') or key == 127:  # Backspace
+                        input_buffer = input_buffer[:-1]
+                    elif 32 <= key <= 126:  # 可列印字符
+                        input_buffer += chr(key)
+                elif jump_mode:
+                    if key == ord('\n') or key == 10:  # Enter鍵
+                        if input_buffer:
+                            target = min(max(int(input_buffer), 1), _MAX_GRID_NOTES)
+                            notes += [None] * (target - len(notes))
+                            c = target - 1
+                        jump_mode = False
+                        input_buffer = ""
+                    elif key == 27:  # ESC
+                        jump_mode = False
+                        input_buffer = ""
+                    elif key == ord('\b') or key == 127:  # Backspace
+                        input_buffer = input_buffer[:-1]
+                    elif ord('0') <= key <= ord('9') and len(input_buffer) < 5:
+                        input_buffer += chr(key)
+                elif bulk_input_mode:
+                    if key == ord('\n') or key == 10:  # Enter鍵
+                        try:
+                            inputs = input_buffer.split()
+                            pos = c
+                            for val in inputs:
+                                if note_name_mode:
+                                    midi_val = parse_note_name(val)
+                                else:
+                                    midi_val = int(val)
+                                if midi_val is not None and 0 <= midi_val <= 127:
+                                    # 超過結尾時延長旋律，已達上限則回到開頭
+                                    if pos == len(notes):
+                                        if len(notes) < _MAX_GRID_NOTES:
+                                            notes.append(None)
+                                        else:
+                                            pos = 0
+                                    notes[pos] = midi_val
+                                    pos += 1
+                            c = min(pos, len(notes) - 1)
+                            bulk_input_mode = False
+                            input_buffer = ""
+                        except ValueError:
+                            pass
+                    elif key == 27:  # ESC
                         bulk_input_mode = False
                         input_buffer = ""
-                    except ValueError:
-                        pass
-                elif key == 27:  # ESC
-                    bulk_input_mode = False
-                    input_buffer = ""
-                elif key == ord('\b') or key == 127:  # Backspace
-                    input_buffer = input_buffer[:-1]
-                elif 32 <= key <= 126:  # 可列印字符
-                    input_buffer += chr(key)
-            else:
-                if key == ord('t') or key == ord('T'):
-                    bulk_input_mode = True
-                    input_buffer = ""
-                elif key == curses.KEY_LEFT:
-                    c = (c - 1) % cols
-                    input_buffer = ""
-                elif key == curses.KEY_RIGHT:
-                    c = (c + 1) % cols
-                    input_buffer = ""
-                elif key == ord(' '):
-                    note_name_mode = not note_name_mode
-                    input_buffer = ""
-                elif key == ord('\b') or key == 127 or key == curses.KEY_DC:
-                    if input_buffer:
+                    elif key == ord('\b') or key == 127:  # Backspace
                         input_buffer = input_buffer[:-1]
-                    else:
-                        notes[c] = None
-                elif 32 <= key <= 126:
-                    if note_name_mode or chr(key).isdigit():
+                    elif 32 <= key <= 126:  # 可列印字符
                         input_buffer += chr(key)
-                        if not note_name_mode and input_buffer and int(input_buffer) > 127:
-                            input_buffer = "127"
-                elif key == ord('\n') or key == 10:
-                    if input_buffer:
-                        if note_name_mode:
-                            midi_val = parse_note_name(input_buffer)
-                            if midi_val is not None:
-                                notes[c] = midi_val
-                        else:
-                            try:
-                                val = int(input_buffer)
-                                if 0 <= val <= 127:
-                                    notes[c] = val
-                            except ValueError:
-                                pass
+                else:
+                    if key == ord('t') or key == ord('T'):
+                        bulk_input_mode = True
                         input_buffer = ""
-                    else:
-                        break
+                    elif key == ord('i') or key == ord('I'):
+                        import_mode = True
+                        input_buffer = ""
+                        message = ""
+                    elif key == ord('j') or key == ord('J'):
+                        jump_mode = True
+                        input_buffer = ""
+                    elif key == curses.KEY_LEFT:
+                        c = max(c - 1, 0)
+                        input_buffer = ""
+                    elif key == curses.KEY_RIGHT:
+                        # 在最後一格時延長旋律
+                        if c == len(notes) - 1 and len(notes) < _MAX_GRID_NOTES:
+                            notes.append(None)
+                        c = min(c + 1, len(notes) - 1)
+                        input_buffer = ""
+                    elif key == curses.KEY_UP:
+                        c = max(c - viewport.per_row, 0)
+                        input_buffer = ""
+                    elif key == curses.KEY_DOWN:
+                        c = min(c + viewport.per_row, len(notes) - 1)
+                        input_buffer = ""
+                    elif key in (curses.KEY_PPAGE, curses.KEY_NPAGE):
+                        c = viewport.page(-1 if key == curses.KEY_PPAGE else 1, c, len(notes))
+                        input_buffer = ""
+                    elif key == curses.KEY_HOME:
+                        c = 0
+                        input_buffer = ""
+                    elif key == curses.KEY_END:
+                        c = len(notes) - 1
+                        input_buffer = ""
+                    elif key == ord(' '):
+                        note_name_mode = not note_name_mode
+                        input_buffer = ""
+                    elif key == ord('\b') or key == 127 or key == curses.KEY_DC:
+                        if input_buffer:
+                            input_buffer = input_buffer[:-1]
+                        else:
+                            notes[c] = None
+                    elif 32 <= key <= 126:
+                        if note_name_mode or chr(key).isdigit():
+                            input_buffer += chr(key)
+                            if not note_name_mode and input_buffer and int(input_buffer) > 127:
+                                input_buffer = "127"
+                    elif key == ord('\n') or key == 10:
+                        if input_buffer:
+                            if note_name_mode:
+                                midi_val = parse_note_name(input_buffer)
+                                if midi_val is not None:
+                                    notes[c] = midi_val
+                            else:
+                                try:
+                                    val = int(input_buffer)
+                                    if 0 <= val <= 127:
+                                        notes[c] = val
+                                except ValueError:
+                                    pass
+                            input_buffer = ""
+                        else:
+                            break
 
     except curses.error:
         stdscr.clear()
@@ -579,28 +1868,45 @@ def select_notes_screen(stdscr):
     selected = []
     for note_val in notes:
         if note_val is not None:
-            n = note.Note(note_val)
-            selected.append([n.nameWithOctave])
+            selected.append([midi_to_cell(note_val)])
         else:
             selected.append([None])
     
     return selected
 
+class _InstrumentTable(Mapping):
+    """樂器名稱到 music21 樂器物件的對照表，物件在第一次取用時才建立"""
+    def __init__(self, class_names):
+        self._class_names = class_names
+        self._instances = {}
+
+    def __getitem__(self, name):
+        if name not in self._instances:
+            self._instances[name] = getattr(instrument, self._class_names[name])()
+        return self._instances[name]
+
+    def __iter__(self):
+        return iter(self._class_names)
+
+    def __len__(self):
+        return len(self._class_names)
+
 # 樂器列表
-AVAILABLE_INSTRUMENTS = {
-    "鋼琴": instrument.Piano(),
-    "原聲吉他": instrument.AcousticGuitar(),
-    "豎琴": instrument.Harp(),
-    "大提琴": instrument.Violoncello(),  # Cello 的正確名稱是 Violoncello
-    "小提琴": instrument.Violin(),
-    "長笛": instrument.Flute(),
-    "單簧管": instrument.Clarinet(),
-    "雙簧管": instrument.Oboe(),
-    "低音提琴": instrument.ElectricBass(),  # 改用電貝斯替代低音管
-    "銅管": instrument.Trumpet()
-}
+AVAILABLE_INSTRUMENTS = _InstrumentTable({
+    "鋼琴": 'Piano',
+    "原聲吉他": 'AcousticGuitar',
+    "豎琴": 'Harp',
+    "大提琴": 'Violoncello',  # Cello 的正確名稱是 Violoncello
+    "小提琴": 'Violin',
+    "長笛": 'Flute',
+    "單簧管": 'Clarinet',
+    "雙簧管": 'Oboe',
+    "低音提琴": 'ElectricBass',  # 改用電貝斯替代低音管
+    "銅管": 'Trumpet'
+})
 
-def select_pattern_screen(stdscr):
+def select_pattern_screen(stdscr, status=None):
+    """選擇是否加入伴奏與各琶音模式的樂器；status 的用法同 select_notes_screen"""
     patterns = list(get_arpeggio_patterns().keys())
     instruments = list(AVAILABLE_INSTRUMENTS.keys())
     current_idx = 0  # 當前選擇的項目索引
@@ -608,14 +1914,15 @@ def select_pattern_screen(stdscr):
     in_instrument_selection = False  # 是否正在選擇樂器
     temp_pattern = None  # 暫存正在配置樂器的琶音模式
     want_accompaniment = None  # 是否要使用伴奏
+    canvas = _DirtyCanvas(stdscr)
     
     def draw_screen():
         height, width = stdscr.getmaxyx()
-        stdscr.clear()
+        canvas.begin()
         
         if height < 20 or width < 80:
-            stdscr.addstr(0, 0, "請調整視窗大小（至少需要80x20）")
-            stdscr.refresh()
+            canvas.addstr(0, 0, "請調整視窗大小（至少需要80x20）")
+            canvas.flush()
             return
             
         title = "選擇是否要加入伴奏#########"
@@ -626,98 +1933,100 @@ def select_pattern_screen(stdscr):
                 title = "將只使用主旋律（無伴奏）"
                 
         # 顯示標題
-        stdscr.addstr(1, 5, title, curses.A_BOLD)
+        canvas.addstr(1, 5, title, curses.A_BOLD)
         
         base_x = 5  # 基本縮排
         
         if want_accompaniment is None:
             # 顯示是否要加入伴奏的選項
-            stdscr.addstr(3, base_x, "是否要加入伴奏？########", curses.A_BOLD)
-            stdscr.addstr(5, base_x, "↑↓ = 選擇", curses.A_NORMAL)
-            stdscr.addstr(6, base_x, "Enter = 確認", curses.A_NORMAL)
+            canvas.addstr(3, base_x, "是否要加入伴奏？########", curses.A_BOLD)
+            canvas.addstr(5, base_x, "↑↓ = 選擇", curses.A_NORMAL)
+            canvas.addstr(6, base_x, "Enter = 確認", curses.A_NORMAL)
             
             options = ["是", "否"]
             for i, opt in enumerate(options):
                 attr = curses.A_REVERSE if i == current_idx else curses.A_NORMAL
-                stdscr.addstr(8 + i, base_x + 4, opt, attr)
+                canvas.addstr(8 + i, base_x + 4, opt, attr)
         
         elif want_accompaniment:
             # 顯示琶音模式選擇
-            stdscr.addstr(3, base_x, "操作說明：", curses.A_NORMAL)
-            stdscr.addstr(4, base_x, "空格 = 選擇琶音模式", curses.A_NORMAL)
-            stdscr.addstr(5, base_x, "Enter = 完成並繼續", curses.A_NORMAL)
-            stdscr.addstr(6, base_x, "ESC = 返回", curses.A_NORMAL)
+            canvas.addstr(3, base_x, "操作說明：", curses.A_NORMAL)
+            canvas.addstr(4, base_x, "空格 = 選擇琶音模式", curses.A_NORMAL)
+            canvas.addstr(5, base_x, "Enter = 完成並繼續", curses.A_NORMAL)
+            canvas.addstr(6, base_x, "ESC = 返回", curses.A_NORMAL)
             
             # 顯示已選擇的琶音模式和樂器
             y_offset = 8
             for i, (pat, inst) in enumerate(selected_patterns):
-                stdscr.addstr(y_offset + i, 10, f"✓ {pat} - 使用{inst}")
+                canvas.addstr(y_offset + i, 10, f"✓ {pat} - 使用{inst}")
             
             y_offset = y_offset + len(selected_patterns) + 2
             
             if in_instrument_selection:
                 # 顯示樂器選擇列表
-                stdscr.addstr(y_offset - 1, 5, f"為「{temp_pattern}」選擇樂器：", curses.A_BOLD)
+                canvas.addstr(y_offset - 1, 5, f"為「{temp_pattern}」選擇樂器：", curses.A_BOLD)
                 for i, inst in enumerate(instruments):
                     attr = curses.A_REVERSE if i == current_idx else curses.A_NORMAL
-                    stdscr.addstr(y_offset + i, 10, f"[{inst}]", attr)
+                    canvas.addstr(y_offset + i, 10, f"[{inst}]", attr)
             else:
                 # 顯示琶音模式列表
                 for i, pat in enumerate(patterns):
                     if not any(p[0] == pat for p in selected_patterns):
                         attr = curses.A_REVERSE if i == current_idx else curses.A_NORMAL
-                        stdscr.addstr(y_offset + i, 10, f"[ ] {pat}", attr)
+                        canvas.addstr(y_offset + i, 10, f"[ ] {pat}", attr)
         
-        stdscr.refresh()
+        _draw_status(canvas, status, height, width)
+        canvas.flush()
     
-    while True:
-        draw_screen()
-        key = stdscr.getch()
-        
-        if want_accompaniment is None:
-            if key == curses.KEY_UP:
-                current_idx = (current_idx - 1) % 2
-            elif key == curses.KEY_DOWN:
-                current_idx = (current_idx + 1) % 2
-            elif key == ord('\n') or key == 10:  # Enter鍵
-                want_accompaniment = (current_idx == 0)  # 0="是"，1="否"
-                if not want_accompaniment:
-                    break
-                current_idx = 0
-                
-        elif want_accompaniment:
-            if in_instrument_selection:
-                if key == curses.KEY_UP:
-                    current_idx = (current_idx - 1) % len(instruments)
-                elif key == curses.KEY_DOWN:
-                    current_idx = (current_idx + 1) % len(instruments)
-                elif key == ord('\n') or key == 10:  # 確認選擇樂器
-                    selected_patterns.append((temp_pattern, instruments[current_idx]))
-                    in_instrument_selection = False
-                    temp_pattern = None
-                    current_idx = 0
-                elif key == 27:  # ESC取消選擇
-                    in_instrument_selection = False
-                    temp_pattern = None
-                    current_idx = 0
-            else:
+    with _polling(stdscr, status is not None):
+        while True:
+            draw_screen()
+            key = stdscr.getch()
+            
+            if want_accompaniment is None:
                 if key == curses.KEY_UP:
-                    current_idx = (current_idx - 1) % len(patterns)
+                    current_idx = (current_idx - 1) % 2
                 elif key == curses.KEY_DOWN:
-                    current_idx = (current_idx + 1) % len(patterns)
-                elif key == 27:  # ESC返回選擇是否使用伴奏
-                    want_accompaniment = None
+                    current_idx = (current_idx + 1) % 2
+                elif key == ord('\n') or key == 10:  # Enter鍵
+                    want_accompaniment = (current_idx == 0)  # 0="是"，1="否"
+                    if not want_accompaniment:
+                        break
                     current_idx = 0
-                    selected_patterns = []
-                elif key == ord(' '):
-                    # 選擇琶音模式後進入樂器選擇
-                    if not any(p[0] == patterns[current_idx] for p in selected_patterns):
-                        temp_pattern = patterns[current_idx]
-                        in_instrument_selection = True
+                    
+            elif want_accompaniment:
+                if in_instrument_selection:
+                    if key == curses.KEY_UP:
+                        current_idx = (current_idx - 1) % len(instruments)
+                    elif key == curses.KEY_DOWN:
+                        current_idx = (current_idx + 1) % len(instruments)
+                    elif key == ord('\n') or key == 10:  # 確認選擇樂器
+                        selected_patterns.append((temp_pattern, instruments[current_idx]))
+                        in_instrument_selection = False
+                        temp_pattern = None
                         current_idx = 0
-                elif key == ord('\n') or key == 10:
-                    if selected_patterns:  # 只有在有選擇時才可以結束
-                        break
+                    elif key == 27:  # ESC取消選擇
+                        in_instrument_selection = False
+                        temp_pattern = None
+                        current_idx = 0
+                else:
+                    if key == curses.KEY_UP:
+                        current_idx = (current_idx - 1) % len(patterns)
+                    elif key == curses.KEY_DOWN:
+                        current_idx = (current_idx + 1) % len(patterns)
+                    elif key == 27:  # ESC返回選擇是否使用伴奏
+                        want_accompaniment = None
+                        current_idx = 0
+                        selected_patterns = []
+                    elif key == ord(' '):
+                        # 選擇琶音模式後進入樂器選擇
+                        if not any(p[0] == patterns[current_idx] for p in selected_patterns):
+                            temp_pattern = patterns[current_idx]
+                            in_instrument_selection = True
+                            current_idx = 0
+                    elif key == ord('\n') or key == 10:
+                        if selected_patterns:  # 只有在有選擇時才可以結束
+                            break
     
     if not want_accompaniment:
         return []
@@ -750,29 +2059,94 @@ def start_screen(stdscr):
         stdscr.refresh()
         stdscr.getch()
 
+def render_progress_screen(stdscr, renders, allow_next=True):
+    """顯示各背景產生的進度；回傳 True 表示使用者要輸入下一段旋律
+
+    N = 輸入下一段旋律（目前的產生繼續在背景執行）
+    C = 取消尚未完成的產生
+    Enter = 全部完成後結束
+    """
+    canvas = _DirtyCanvas(stdscr)
+    with _polling(stdscr, True):
+        while True:
+            height, width = stdscr.getmaxyx()
+            running = [r for r in renders if not r.done()]
+            try:
+                canvas.begin()
+                canvas.addstr(1, 5, "產生 MIDI 中" if running else "全部完成", curses.A_BOLD)
+                # 只顯示最近的幾筆；視窗很矮時至少顯示一筆
+                for i, render in enumerate(renders[-max(1, height - 8):]):
+                    text = render.status_text()
+                    if not render.done():
+                        filled = int(render.progress.fraction() * 20)
+                        text = f"[{'#' * filled}{'-' * (20 - filled)}] {text}"
+                    canvas.addstr(3 + i, 5, _fit_width(text, width - 6))
+                help_lines = []
+                if allow_next:
+                    help_lines.append("N = 輸入下一段旋律")
+                if running:
+                    help_lines.append("C = 取消產生")
+                help_lines.append("Enter = 結束" if not running else "Enter = 等待完成後結束")
+                canvas.addstr(height - 2, 5, _fit_width("　".join(help_lines), width - 6))
+                canvas.flush()
+            except curses.error:
+                # 處理畫面太小的情況；產生仍在背景繼續，視窗調整後下一輪重畫
+                canvas.invalidate()
+                try:
+                    stdscr.erase()
+                    stdscr.addstr(0, 0, "請調整視窗大小")
+                    stdscr.refresh()
+                except curses.error:
+                    pass
+            
+            key = stdscr.getch()
+            if key in (ord('n'), ord('N')) and allow_next:
+                return True
+            elif key in (ord('c'), ord('C')):
+                for render in running:
+                    render.cancel()
+            elif key == ord('\n') or key == 10:
+                for render in running:
+                    render.join()
+                # 等待期間可能有新的結果，讓畫面再顯示一次最終狀態
+                if running:
+                    continue
+                return False
+
 def main(stdscr):
     curses.curs_set(0)  # 隱藏游標
     start_screen(stdscr)
-      
-    # 選擇旋律音符
-    note_matrix = select_notes_screen(stdscr)
-    if not any(any(col) for col in note_matrix):
-        stdscr.clear()
-        stdscr.addstr(5, 5, "未選擇任何音符，程式結束。")
-        stdscr.refresh()
-        stdscr.getch()
-        return
+    renders = []  # 已送到背景產生的作品
+    try:
+        cache = render_cache.RenderCache()
+    except OSError:
+        cache = None  # 無法建立快取目錄時照常產生
     
-    # 選擇琶音模式和樂器
-    pattern_instruments = select_pattern_screen(stdscr)
-    path = build_score(note_matrix, pattern_instruments, 'output.mid')
+    def status():
+        running = [r for r in renders if not r.done()]
+        return ("背景產生：" + running[-1].status_text()) if running else None
     
-    # 顯示完成訊息
-    stdscr.clear()
-    stdscr.addstr(5, 5, f"✓ MIDI已生成: {path}")
-    stdscr.addstr(7, 5, "按任意鍵結束。")
-    stdscr.refresh()
-    stdscr.getch()
+    while True:
+        # 選擇旋律音符
+        note_matrix = select_notes_screen(stdscr, status if renders else None)
+        if not any(any(col) for col in note_matrix):
+            if renders:
+                render_progress_screen(stdscr, renders, allow_next=False)
+                return
+            stdscr.clear()
+            stdscr.addstr(5, 5, "未選擇任何音符，程式結束。")
+            stdscr.refresh()
+            stdscr.getch()
+            return
+        
+        # 選擇琶音模式和樂器
+        pattern_instruments = select_pattern_screen(stdscr, status if renders else None)
+        
+        # 在背景產生，之後的作品依序輸出為 output_2.mid、output_3.mid…
+        output = 'output.mid' if not renders else f'output_{len(renders) + 1}.mid'
+        renders.append(BackgroundRender(note_matrix, pattern_instruments, output, cache))
+        if not render_progress_screen(stdscr, renders):
+            return
 
 if __name__ == '__main__':
     curses.wrapper(main)
@@ -0,0 +1,254 @@
+"""即時 MIDI 播放：將 build_score 的主旋律與伴奏事件依時間送出原始 MIDI 位元組。
+
+各聲部的事件先以 midi_io.merge_messages 合併成依時間排序的訊息，再由排程器依
+絕對時間送到輸出端（sink）。每個訊息的期限都由開始時間加上預定時間計算，
+不累加每次 sleep 的誤差，因此長時間播放也不會漂移；同一時間點的訊息合併成
+一批送出，每批實際送出時間與期限的差距記錄為抖動統計。
+
+輸出端只需實作 send(timestamp, data) 與 close()，timestamp 為預定的播放秒數：
+    RawSink        將原始 MIDI 位元組寫入檔案、管線、FIFO 或 MIDI 裝置（如 /dev/snd/midiC1D0）
+    LogSink        將「秒數 十六進位位元組」逐行寫入文字檔，沒有硬體時供測試
+    CallbackSink   交給自訂函式處理
+
+用法：
+    python playback.py C4 E4 G4 C5 --pattern 上升琶音=鋼琴 --out /tmp/midi.fifo
+    python playback.py 60 64 67 72 --log events.txt --speed 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import groupby
+from operator import itemgetter
+
+import midi_io
+import music_composer
+
+# 距離期限不到這個秒數時改為忙碌等待，避免 sleep 的喚醒誤差
+SPIN_SECONDS = 0.002
+# 每次 sleep 的上限，讓 stop 事件能及時生效
+MAX_SLEEP_SECONDS = 0.05
+# 開始播放前預留的時間，讓第一批訊息也能準時送出
+START_DELAY_SECONDS = 0.01
+# 計算延遲百分位數時最多保留的樣本數
+LATENESS_SAMPLES = 4096
+
+
+# ========== 輸出端 ==========
+
+class RawSink:
+    """將原始 MIDI 位元組寫入二進位檔案物件或路徑
+
+    路徑為 FIFO 時，開啟會等到另一端有讀取者為止。
+    """
+    def __init__(self, target):
+        if isinstance(target, (str, os.PathLike)):
+            self._fp = open(target, 'wb', buffering=0)
+            self._owned = True
+        else:
+            self._fp = target
+            self._owned = False
+
+    def send(self, timestamp, data):
+        self._fp.write(data)
+        if hasattr(self._fp, 'flush'):
+            self._fp.flush()
+
+    def close(self):
+        if self._owned:
+            self._fp.close()
+
+
+class LogSink:
+    """將每批訊息寫成一行「預定秒數 十六進位位元組」"""
+    def __init__(self, target):
+        if isinstance(target, (str, os.PathLike)):
+            self._fp = open(target, 'w', encoding='utf-8')
+            self._owned = True
+        else:
+            self._fp = target
+            self._owned = False
+
+    def send(self, timestamp, data):
+        self._fp.write(f"{timestamp:.6f} {data.hex(' ')}\n")
+
+    def close(self):
+        if self._owned:
+            self._fp.close()
+        else:
+            self._fp.flush()
+
+
+class CallbackSink:
+    """以 callback(timestamp, data) 處理每批訊息"""
+    def __init__(self, callback):
+        self._callback = callback
+
+    def send(self, timestamp, data):
+        self._callback(timestamp, data)
+
+    def close(self):
+        pass
+
+
+# ========== 排程 ==========
+
+class PlaybackStats:
+    """記錄每批訊息的送出延遲（實際送出時間減去期限，秒）
+
+    平均與最大值以累計值計算；中位數與 p99 取自最多 sample_size 筆的蓄水池抽樣，
+    長時間或循環播放時記憶體也不會增加。
+    """
+    def __init__(self, sample_size=LATENESS_SAMPLES):
+        self.batches = 0
+        self.messages = 0
+        self.position = 0.0  # 最後一批訊息的預定秒數
+        self.stopped = False
+        self._total = 0.0
+        self._max = 0.0
+        self._samples = []
+        self._sample_size = sample_size
+        self._random = random.Random(0)
+
+    def record(self, lateness, messages):
+        self.batches += 1
+        self.messages += messages
+        self._total += lateness
+        if self.batches == 1 or lateness > self._max:
+            self._max = lateness
+        if len(self._samples) < self._sample_size:
+            self._samples.append(lateness)
+        else:
+            j = self._random.randrange(self.batches)
+            if j < self._sample_size:
+                self._samples[j] = lateness
+
+    def summary(self):
+        """回傳批次數、訊息數與延遲的平均、中位數、p99、最大值（毫秒）"""
+        if not self.batches:
+            return {'batches': 0, 'messages': 0, 'stopped': self.stopped}
+        ordered = sorted(self._samples)
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'stopped': self.stopped,
+            'mean_ms': self._total / self.batches * 1000,
+            'p50_ms': ordered[len(ordered) // 2] * 1000,
+            'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            'max_ms': self._max * 1000,
+        }
+
+
+def _wait_until(deadline, clock, sleep, stop):
+    """等待到 deadline：距離較遠時 sleep，最後一小段忙碌等待；stop 被設定時提早返回"""
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0 or (stop is not None and stop.is_set()):
+            return
+        if remaining > SPIN_SECONDS:
+            sleep(min(remaining - SPIN_SECONDS, MAX_SLEEP_SECONDS))
+
+
+def schedule(messages, sink, seconds_per_tick, stop=None, stats=None,
+             clock=time.perf_counter, sleep=time.sleep):
+    """依 (tick, 位元組) 訊息的絕對時間送到 sink，回傳 PlaybackStats
+
+    同一 tick 的訊息合併成一批送出。送出較晚時後續期限不受影響，會自然追上。
+    """
+    stats = stats or PlaybackStats()
+    start = clock() + START_DELAY_SECONDS
+    for tick, group in groupby(messages, key=itemgetter(0)):
+        batch = [message for _, message in group]
+        deadline = start + tick * seconds_per_tick
+        _wait_until(deadline, clock, sleep, stop)
+        if stop is not None and stop.is_set():
+            stats.stopped = True
+            break
+        now = clock()
+        stats.position = tick * seconds_per_tick
+        sink.send(stats.position, b''.join(batch))
+        stats.record(now - deadline, len(batch))
+    return stats
+
+
+def _all_notes_off(part_count):
+    """各聲部頻道的 All Notes Off（CC 123）"""
+    return b''.join(bytes([0xB0 | midi_io.channel_for_part(idx), 123, 0])
+                    for idx in range(part_count))
+
+
+def play(parts, sink, tempo=midi_io.DEFAULT_TEMPO, speed=1.0, stop=None):
+    """播放 midi_io 格式的聲部列表 [(事件, program, 名稱)]，回傳 PlaybackStats
+
+    speed 大於 1 時加快播放。結束或中斷時會送出 All Notes Off，但不關閉 sink。
+    """
+    seconds_per_tick = tempo / 1e6 / midi_io.TICKS_PER_QUARTER / speed
+    stats = PlaybackStats()
+    try:
+        schedule(midi_io.merge_messages(parts), sink, seconds_per_tick, stop, stats)
+    except BaseException:
+        # 輸出端可能已失效（例如讀取端關閉了管線），不讓 All Notes Off 的錯誤蓋過原本的例外
+        try:
+            sink.send(stats.position, _all_notes_off(len(parts)))
+        except OSError:
+            pass
+        raise
+    sink.send(stats.position, _all_notes_off(len(parts)))
+    return stats
+
+
+def play_score(selected_notes, pattern_instruments, sink, num_measures=None, speed=1.0,
+               stop=None):
+    """以與 build_score 相同的方式規劃樂曲並即時播放，回傳 PlaybackStats"""
+    plan = music_composer.plan_score(selected_notes, num_measures=num_measures)
+    parts = music_composer.score_parts(plan, pattern_instruments)
+    return play(parts, sink, speed=speed, stop=stop)
+
+
+def main(argv=None):
+    import batch_composer
+
+    parser = argparse.ArgumentParser(description="MIDI 作曲助手：即時播放")
+    parser.add_argument('notes', nargs='+', help="旋律音符（音名或 MIDI 值，- 表示空格）")
+    parser.add_argument('--pattern', action='append', default=[],
+                        help="伴奏，格式為 琶音模式=樂器，可重複指定")
+    parser.add_argument('--measures', type=int, default=None, help="產生的小節數")
+    parser.add_argument('--speed', type=float, default=1.0, help="播放速度倍率（預設 1）")
+    parser.add_argument('--out', default=None, help="原始 MIDI 位元組的輸出（檔案、管線或 FIFO）")
+    parser.add_argument('--log', default=None, help="將時間與訊息寫入文字檔（預設為標準輸出）")
+    args = parser.parse_args(argv)
+    for p in args.pattern:
+        if '=' not in p:
+            parser.error(f"--pattern 的格式為 琶音模式=樂器：{p}")
+
+    job = {
+        'notes': [None if n == '-' else int(n) if n.isdigit() else n for n in args.notes],
+        'patterns': [p.split('=', 1) for p in args.pattern],
+    }
+    try:
+        selected_notes, pattern_instruments = batch_composer.job_to_arguments(music_composer, job)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.out:
+        sink = RawSink(args.out)
+    else:
+        sink = LogSink(args.log or sys.stdout)
+
+    try:
+        stats = play_score(selected_notes, pattern_instruments, sink, args.measures, args.speed)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        sink.close()
+
+    s = stats.summary()
+    if s['batches']:
+        print(f"送出 {s['messages']} 個訊息（{s['batches']} 批）；延遲 平均 {s['mean_ms']:.3f} ms，"
+              f"p50 {s['p50_ms']:.3f} ms，p99 {s['p99_ms']:.3f} ms，最大 {s['max_ms']:.3f} ms",
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
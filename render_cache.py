@@ -0,0 +1,154 @@
+"""以內容雜湊為鍵的產生結果快取，存在磁碟上並依大小上限以 LRU 淘汰。
+
+每筆資料存成 <目錄>/<鍵前兩碼>/<鍵>.mid，讀取命中時更新檔案的修改時間，
+淘汰時從修改時間最舊的開始刪除，直到總大小不超過上限。寫入先寫到暫存檔再以
+os.replace 換上，多個行程共用同一個目錄也不會讀到寫到一半的資料。
+
+同一個 RenderCache 可以在多個執行緒間共用。多個行程共用同一個目錄時，
+每個行程在索引估計超過上限、或自上次掃描後已寫入上限的 1/16 時重新掃描目錄，
+把其他行程寫入的項目也算進去再淘汰，因此上限對整個目錄有效；N 個行程同時
+寫入時最多短暫超出約 N/16 倍的上限。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# 自上次掃描後寫入超過上限的此比例時重新掃描目錄
+_RESCAN_FRACTION = 16
+
+
+def content_key(payload):
+    """將可轉成 JSON 的資料轉成固定的 sha256 十六進位字串"""
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def default_cache_dir():
+    """預設的快取目錄：環境變數 MUSIC_COMPOSER_CACHE，或 ~/.cache/music-composer"""
+    return os.environ.get('MUSIC_COMPOSER_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'music-composer')
+
+
+class RenderCache:
+    """磁碟上的位元組快取，總大小超過 max_bytes 時淘汰最久沒用到的項目"""
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}  # 鍵 -> (最後使用時間, 大小)
+        self._stored_since_scan = 0
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.mid')
+
+    def _scan(self):
+        """讀取目錄中既有的項目，重新建立記憶體中的索引（呼叫端須持有鎖或尚未共用）"""
+        index = {}
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.mid'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue  # 其他行程剛刪除
+                    index[entry.name[:-4]] = (st.st_mtime, st.st_size)
+        self._index = index
+        self._stored_since_scan = 0
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self):
+        return sum(size for _, size in self._index.values())
+
+    def get(self, key):
+        """回傳快取的位元組，沒有時回傳 None"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._index.pop(key, None)
+                self.misses += 1
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            self._index[key] = (now, len(data))
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """存入位元組，必要時淘汰舊項目；單筆就超過上限時不存"""
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._index[key] = (time.time(), len(data))
+            self.stores += 1
+            self._stored_since_scan += len(data)
+            self._evict()
+
+    def _evict(self):
+        """從最久沒用到的項目開始刪除，直到總大小不超過上限；呼叫端須持有鎖"""
+        total = self._total_bytes()
+        if total <= self.max_bytes and self._stored_since_scan < self.max_bytes // _RESCAN_FRACTION:
+            return
+        self._scan()  # 把其他行程寫入或刪除的項目算進去
+        total = self._total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key, (_, size) in sorted(self._index.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass  # 其他行程已經刪除
+            self._index.pop(key, None)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+            self._index.clear()
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'stores': self.stores, 'evictions': self.evictions,
+                    'entries': len(self._index), 'bytes': self._total_bytes()}
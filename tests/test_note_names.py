@@ -0,0 +1,29 @@
+"""音名與 MIDI 值轉換的往返測試"""
+import pytest
+
+import batch_composer
+import music_composer
+
+
+def test_cells_round_trip_every_midi_value():
+    for midi_val in range(128):
+        cell = music_composer.midi_to_cell(midi_val)
+        assert music_composer.note_name_to_midi(cell) == midi_val
+
+
+def test_names_round_trip_outside_octave_minus_one():
+    for midi_val in range(12, 128):
+        name = music_composer.midi_to_note_name(midi_val)
+        assert music_composer.note_name_to_midi(name) == midi_val
+
+
+def test_job_keeps_low_midi_values():
+    selected_notes, _ = batch_composer.job_to_arguments(music_composer, {'notes': [0, 5, 7, 60]})
+    assert [music_composer.note_name_to_midi(row[0]) for row in selected_notes] == [0, 5, 7, 60]
+
+
+@pytest.mark.parametrize('name', ['C123', 'G10', 'H9'])
+def test_rejects_names_outside_midi_range(name):
+    with pytest.raises(Exception):
+        music_composer.note_name_to_midi(name)
+    assert music_composer.conversion_stats()['cached'] <= 1024